@@ -1,8 +1,33 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, make_response, g
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from werkzeug.exceptions import HTTPException
+import hmac
+import json
+import math
+import requests
+import Caching
+import Catalog
+import Events
+import Health
+import Invalidation
+import Jobs
+import Resilience
 import Routes
+import Sessions
+import Throttling
 
 api = Flask(__name__)
 
+REFERENCE_CACHE_TTL = float(environ.get('BUNNY_REFERENCE_CACHE_TTL', 86400)) # Country, region & language lists rarely change.
+VIDEO_CACHE_TTL = float(environ.get(                                        # Video reads are invalidated by webhooks in every worker,
+    'BUNNY_VIDEO_CACHE_TTL', 3600 if Invalidation.journal.enabled else 60   # so they can live long unless the journal is disabled.
+))
+WEBHOOK_SECRET = environ.get('BUNNY_WEBHOOK_SECRET')                        # When set, webhook calls must carry it as ?secret= or X-Webhook-Secret.
+BATCH_MAX_ITEMS = int(environ.get('BUNNY_BATCH_MAX_ITEMS', 100))     # Sub-requests accepted per `/batch` call.
+BATCH_CONCURRENCY = int(environ.get('BUNNY_BATCH_CONCURRENCY', 8))   # Upper bound on sub-requests run at once per `/batch` call.
+
 api_routes = [
     {
         "rule": "/country",
@@ -15,6 +40,10 @@ api_routes = [
                 401: "The request authorization failed",
                 403: "Forbidden",
                 500: "Internal Server Error"
+            },
+            "cache": {
+                "ttl": REFERENCE_CACHE_TTL,
+                "maxsize": 16
             }
         }
     },
@@ -41,6 +70,10 @@ api_routes = [
             "responses": {
                 200: Routes.RESPONSEDATA,
                 500: "Internal Server Error"
+            },
+            "cache": {
+                "ttl": REFERENCE_CACHE_TTL,
+                "maxsize": 16
             }
         }
     },
@@ -149,6 +182,24 @@ api_routes = [
                 200: Routes.RESPONSEDATA,
                 401: "The request authorization failed",
                 500: "Internal Server Error"
+            },
+            "cache": {
+                "ttl": REFERENCE_CACHE_TTL,
+                "maxsize": 16
+            }
+        }
+    },
+    {
+        "rule": "/videolibrary/statistics",
+        "methods": ["GET", "POST"],
+        "view_func": Routes.GetStatisticsRollup,
+        "metadata": {
+            "description": "Get Video Statistics merged across libraries",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                401: "The request authorization failed",
+                404: "The requested library does not exist",
+                500: "Internal Server Error"
             }
         }
     },
@@ -183,6 +234,34 @@ api_routes = [
             }
         }
     },
+    {
+        "rule": "/purge/bulk",
+        "methods": ["POST"],
+        "view_func": Routes.BulkPurge,
+        "metadata": {
+            "description": "Purge many URLs or wildcard patterns",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                202: Routes.RESPONSEDATA,
+                400: Routes.RESPONSEDATA,
+                500: "Internal Server Error"
+            },
+            "blocking": True # Dispatches its own purges; the async engine runs it on a worker thread.
+        }
+    },
+    {
+        "rule": "/purge/bulk/<jobId>",
+        "methods": ["GET"],
+        "view_func": Routes.GetBulkPurgeJob,
+        "metadata": {
+            "description": "Get bulk purge progress",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                404: "The requested purge job does not exist on this worker",
+                500: "Internal Server Error"
+            }
+        }
+    },
     {
         "rule": "/storagezone",
         "methods": ["GET"],
@@ -362,9 +441,35 @@ api_routes = [
                 401: "The request authorization failed",
                 404: "The requested video does not exist",
                 500: "Internal Server Error"
+            },
+            "coalesce": {
+                "timeout": Routes.COALESCE_TIMEOUT
+            },
+            "upstream": {
+                "read_timeout": 10,
+                "hedge": True
+            },
+            "cache": {
+                "ttl": VIDEO_CACHE_TTL, # Kept fresh by `bunny_webhook` and by mutations made through this proxy.
+                "maxsize": 4096
             }
         }
     },
+    {
+        "rule": "/library/<libraryId>/videos/bulk",
+        "methods": ["GET", "POST"],
+        "view_func": Routes.GetVideosBulk,
+        "metadata": {
+            "description": "Get Videos in bulk",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                401: "The request authorization failed",
+                404: "The requested video does not exist",
+                500: "Internal Server Error"
+            },
+            "mutates": False # POST only carries the IDs to read.
+        }
+    },
     {
         "rule": "/library/<libraryId>/videos/<videoId>",
         "methods": ["POST"],
@@ -393,6 +498,30 @@ api_routes = [
             }
         }
     },
+    {
+        "rule": "/library/<libraryId>/videos/<videoId>",
+        "methods": ["PUT"],
+        "view_func": Routes.UploadVideo,
+        "metadata": {
+            "description": "Upload Video",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                400: "The upload was incomplete or invalid",
+                401: "The request authorization failed",
+                404: "The requested video does not exist",
+                411: "The upload must specify its Content-Length",
+                500: "Internal Server Error"
+            },
+            "blocking": True, # Streams the request body, so the async engine must not buffer it.
+            "upstream": {
+                "read_timeout": Routes.UPLOAD_TIMEOUT,
+                "circuit": {
+                    "per_route": True, # Long uploads are expected and must not trip the breaker of other video calls.
+                    "slow_call": math.inf
+                }
+            }
+        }
+    },
     {
         "rule": "/library/<libraryId>/videos/<videoId>/heatmap",
         "methods": ["GET"],
@@ -407,6 +536,21 @@ api_routes = [
             }
         }
     },
+    {
+        "rule": "/library/<libraryId>/videos/<videoId>/events",
+        "methods": ["GET"],
+        "view_func": Events.VideoEvents,
+        "metadata": {
+            "description": "Stream Video encode progress as Server-Sent Events",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                401: "The request authorization failed",
+                404: "The requested video does not exist",
+                503: "Too many videos are being watched, retry later"
+            },
+            "event_stream": True # Never ends by itself, so it can't be a `/batch` sub-request.
+        }
+    },
     {
         "rule": "/library/<libraryId>/videos/<videoId>/play",
         "methods": ["GET"],
@@ -418,19 +562,30 @@ api_routes = [
                 401: "The request authorization failed",
                 404: "The requested video does not exist",
                 500: "Internal Server Error"
+            },
+            "coalesce": {
+                "timeout": Routes.COALESCE_TIMEOUT
+            },
+            "upstream": {
+                "read_timeout": 10,
+                "hedge": True
+            },
+            "cache": {
+                "ttl": VIDEO_CACHE_TTL, # Kept fresh by `bunny_webhook` and by mutations made through this proxy.
+                "maxsize": 4096
             }
         }
     },
     {
         "rule": "/library/<libraryId>/statistics",
         "methods": ["GET"],
-        "view_func": Routes.GetVideoPlayData,
+        "view_func": Routes.GetVideoStatistics,
         "metadata": {
-            "description": "Get Video play data",
+            "description": "Get Video Statistics",
             "responses": {
                 200: Routes.RESPONSEDATA,
                 401: "The request authorization failed",
-                404: "The requested video does not exist",
+                404: "The requested library does not exist",
                 500: "Internal Server Error"
             }
         }
@@ -465,6 +620,57 @@ api_routes = [
             }
         }
     },
+    {
+        "rule": "/library/<libraryId>/jobs",
+        "methods": ["POST"],
+        "view_func": Jobs.CreateJob,
+        "metadata": {
+            "description": "Reencode or repackage many videos in the background",
+            "responses": {
+                202: Routes.RESPONSEDATA,
+                400: "The job is invalid",
+                404: "Bulk jobs are disabled"
+            },
+            "mutates": False # The job changes the videos later; the runner invalidates them as it goes.
+        }
+    },
+    {
+        "rule": "/jobs/<jobId>",
+        "methods": ["GET"],
+        "view_func": Jobs.GetJob,
+        "metadata": {
+            "description": "Progress of a bulk job",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                404: "Bulk jobs are disabled"
+            }
+        }
+    },
+    {
+        "rule": "/jobs/<jobId>",
+        "methods": ["DELETE"],
+        "view_func": Jobs.CancelJob,
+        "metadata": {
+            "description": "Cancel a bulk job",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                404: "Bulk jobs are disabled"
+            }
+        }
+    },
+    {
+        "rule": "/library/<libraryId>/catalog",
+        "methods": ["GET"],
+        "view_func": Catalog.SearchCatalog,
+        "metadata": {
+            "description": "Search the local mirror of a library's videos",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                404: "The catalog mirror is disabled",
+                503: "The catalog of this library is still being built"
+            }
+        }
+    },
     {
         "rule": "/library/<libraryId>/videos",
         "methods": ["GET"],
@@ -475,6 +681,10 @@ api_routes = [
                 200: Routes.RESPONSEDATA,
                 401: "The request authorization failed",
                 500: "Internal Server Error"
+            },
+            "cache": {
+                "ttl": VIDEO_CACHE_TTL,
+                "maxsize": 1024
             }
         }
     },
@@ -565,6 +775,21 @@ api_routes = [
             }
         }
     },
+    {
+        "rule": "/library/<libraryId>/captions/batch",
+        "methods": ["POST"],
+        "view_func": Routes.CaptionBatch,
+        "metadata": {
+            "description": "Add captions and transcribe videos in bulk",
+            "responses": {
+                200: Routes.RESPONSEDATA,
+                400: "The batch is invalid",
+                401: "The request authorization failed",
+                500: "Internal Server Error"
+            },
+            "blocking": True # Calls Bunny from its own worker threads; the async engine runs it on a worker thread.
+        }
+    },
     {
         "rule": "/library/<libraryId>/videos/<videoId>/resolutions",
         "methods": ["GET"],
@@ -593,6 +818,18 @@ api_routes = [
             }
         }
     },
+    {
+        "rule": "/library/<libraryId>/videos/create_upload_signatures",
+        "methods": ["GET", "POST"],
+        "view_func": Routes.CreateUploadSignatures,
+        "metadata": {
+            "description": "Creates TUS upload signatures for several videos at once",
+            "responses": {
+                200: Routes.RESPONSEDATA
+            },
+            "mutates": False # POST only carries the IDs to read.
+        }
+    },
     {
         "rule": "/library/<libraryId>/videos/<videoId>/create_upload_signature",
         "methods": ["GET"],
@@ -612,28 +849,316 @@ def application_status():
     '''
     Route for application status checks. 
     This is here instead of `Routes.py` as it's not a route linked to a Bunny API function.
+    Upstream status comes from the last background probe (`Health.prober`), so this never waits on Bunny.
     '''
+    Health.prober.ensure_running()
+    upstreams = Health.prober.snapshot()
+    bunny_api = upstreams.get("api.bunny.net")
     return jsonify({
         "service_status": 200,
-        "bunny_status": Routes.get_bunny_api_status()
+        "bunny_status": bunny_api["status"] if bunny_api is not None else None,
+        "upstreams": upstreams,
+        "circuits": Resilience.breaker_stats(),
+        "events": Events.hub.stats()
     })
 
+@api.route('/status/pool', endpoint='pool_status')
+def pool_status():
+    '''Connection pool statistics for each upstream host, used to size `BUNNY_POOL_MAXSIZE`.'''
+    return jsonify(Sessions.pool_stats())
+
+@api.route('/status/throttle', endpoint='throttle_status')
+def throttle_status():
+    '''Upstream scheduler state: queue depth, delayed and shed requests, 429s from Bunny and paused AccessKeys.'''
+    return jsonify(Routes.upstream_scheduler.stats())
+
+@api.errorhandler(Throttling.UpstreamThrottled)
+def upstream_throttled(error):
+    response = make_response(jsonify("Too many requests to Bunny, retry later"), 429)
+    response.headers["Retry-After"] = str(math.ceil(error.retry_after))
+    return response
+
+@api.errorhandler(requests.Timeout)
+def upstream_timeout(error):
+    return make_response(jsonify("Bunny did not respond in time"), 504)
+
+@api.errorhandler(requests.ConnectionError)
+def upstream_unreachable(error):
+    return make_response(jsonify("Bunny could not be reached"), 502)
+
+@api.errorhandler(Resilience.CircuitOpen)
+def upstream_circuit_open(error):
+    '''Fails fast while an upstream's breaker is open, serving the route's last cached body instead when it has one.'''
+    cache = response_caches.get((str(request.url_rule), request.method))
+    cache_key = getattr(request, "response_cache_key", None)
+    stale = cache.get_stale(cache_key) if cache is not None and cache_key is not None else None
+    if stale is not None:
+        status_code, content_type, body = stale
+        response = Response(body, status = status_code, content_type = content_type)
+        response.headers["X-Cache"] = "STALE"
+        return response
+
+    response = make_response(jsonify("Bunny is currently unavailable, retry later"), 503)
+    response.headers["Retry-After"] = str(math.ceil(error.retry_after))
+    return response
+
+@api.route('/status/cache', endpoint='cache_status')
+def cache_status():
+    '''Hit/miss counters for the response caches configured in `api_routes` and the library API key cache.'''
+    return jsonify({
+        "responses": {
+            f"{method} {rule}": cache.stats() for (rule, method), cache in response_caches.items()
+        },
+        "library_api_keys": Routes.library_api_keys.stats(),
+        "storage_zone_statistics": Routes.storage_zone_statistics.stats(),
+        "library_daily_statistics": Routes.library_daily_statistics.stats(),
+        "invalidation": Invalidation.journal.stats()
+    })
+
+@api.route('/status/cache/flush', methods=["POST"], endpoint='flush_cache')
+def flush_cache():
+    '''Empties every response cache, or only those of the route given by the `rule` query parameter.'''
+    rule = request.args.get("rule")
+    flushed = []
+    for (cache_rule, method), cache in response_caches.items():
+        if rule is None or rule == cache_rule:
+            cache.clear()
+            flushed.append(f"{method} {cache_rule}")
+    return jsonify({"flushed": flushed})
+
+def parse_batch_items(payload) -> list:
+    '''Validates a `/batch` payload, raising `ValueError` with a client-facing message when it is malformed.'''
+    if not isinstance(payload, list):
+        raise ValueError("The request body must be a JSON array of {method, path, body} sub-requests")
+    if len(payload) > BATCH_MAX_ITEMS:
+        raise ValueError(f"A batch may contain at most {BATCH_MAX_ITEMS} sub-requests")
+    return payload
+
+def batch_concurrency(requested) -> int:
+    '''Sub-requests to run at once: the `concurrency` query parameter, capped at `BATCH_CONCURRENCY`.'''
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        return BATCH_CONCURRENCY
+    return max(1, min(requested, BATCH_CONCURRENCY))
+
+def batch_item_environ(item) -> dict:
+    '''Builds the WSGI environ for one `/batch` sub-request, raising `ValueError` when the item is malformed.'''
+    if not isinstance(item, dict):
+        raise ValueError("Sub-requests must be objects with method, path and body")
+    method = str(item.get("method", "GET")).upper()
+    path = item.get("path")
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise ValueError("Sub-request path must be an absolute path such as /library/1/videos/abc")
+    if path.split("?", 1)[0].rstrip("/") == "/batch":
+        raise ValueError("Batches cannot be nested")
+    if method not in Routes.allowed_methods:
+        raise ValueError(f"Unsupported HTTP method: {method}")
+    try:
+        rule, _ = api.url_map.bind("localhost").match(path.split("?", 1)[0], method = method, return_rule = True)
+    except HTTPException:
+        rule = None # Left to the sub-request to answer with its 404 or 405.
+    if rule is not None and (route_metadata.get((rule.rule, method)) or {}).get("event_stream", False):
+        raise ValueError("Event streams cannot be batched")
+
+    return EnvironBuilder(
+        path = path,
+        method = method,
+        data = json.dumps(item.get("body")),
+        content_type = "application/json"
+    ).get_environ()
+
+def batch_item_result(status: str, headers, body: bytes) -> dict:
+    '''Formats one sub-request's outcome, decoding JSON bodies so the batch response stays a single document.'''
+    content_type = dict(headers).get("Content-Type", "")
+    if "json" in content_type and body:
+        try:
+            body = json.loads(body)
+        except ValueError:
+            body = body.decode(errors = "replace")
+    else:
+        body = body.decode(errors = "replace")
+    return {
+        "status": int(status.split(" ", 1)[0]),
+        "body": body
+    }
+
+def run_batch_item(item) -> dict:
+    try:
+        environ = batch_item_environ(item)
+    except ValueError as e:
+        return {"status": 400, "body": str(e)}
+    body_iterable, status, headers = run_wsgi_app(api.wsgi_app, environ, buffered = True)
+    return batch_item_result(status, headers.to_wsgi_list(), b"".join(body_iterable))
+
+@api.route('/batch', methods=["POST"], endpoint='batch')
+def batch():
+    '''
+    Runs a JSON array of {method, path, body} sub-requests against the routes of this API.
+    Sub-requests run on a worker pool bounded by `BATCH_CONCURRENCY`; results come back in request order with per-item status.
+    '''
+    try:
+        items = parse_batch_items(request.get_json(silent = True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not items:
+        return jsonify({"results": []})
+
+    with ThreadPoolExecutor(max_workers = min(batch_concurrency(request.args.get("concurrency")), len(items))) as executor:
+        results = list(executor.map(run_batch_item, items))
+    return jsonify({"results": results})
+
+route_metadata = {} # (rule, method) -> metadata, built once as routes are registered.
+response_caches = {} # (rule, method) -> Caching.TTLCache, for routes with "cache" metadata.
+
+def response_cache_key(cache_config: dict) -> tuple:
+    '''Cache key for the current request: its path, query string and the headers listed in the route's "vary" setting.'''
+    return (
+        request.path,
+        request.query_string,
+        tuple(request.headers.get(header, "") for header in cache_config.get("vary", []))
+    )
+
 @api.before_request
 def apply_request_metadata_context():
-    path_routes = [route for route in api_routes if route['rule'] == str(request.url_rule)]
-    route = [route for route in path_routes if request.method in route['methods']]
-    
-    if len(route) > 1:
-        raise Exception("Multiple routes found in api_routes for given rule and method")
-    elif len(route) == 1:
-        route = route[0]
-        request.metadata = route.get('metadata')
+    metadata = route_metadata.get((str(request.url_rule), request.method))
+    if metadata is None and request.method == "HEAD":
+        metadata = route_metadata.get((str(request.url_rule), "GET")) # Flask answers HEAD with the GET view.
+    if metadata is not None:
+        request.metadata = metadata
+
+@api.teardown_request
+def close_unsent_upstream_responses(exc):
+    '''Closes streamed upstream responses that never made it into a client response, e.g. because the view raised.'''
+    for bunny_response in g.pop("streamed_responses", []):
+        bunny_response.close()
+
+@api.before_request
+def serve_cached_response():
+    cache = response_caches.get((str(request.url_rule), request.method))
+    if cache is None:
+        return None
+    Invalidation.journal.ensure_running() # Restarted in each forked worker before it serves anything from its cache.
+
+    request.response_cache_key = response_cache_key(request.metadata['cache'])
+    cached = cache.get(request.response_cache_key)
+    if cached is None:
+        return None
+
+    status_code, content_type, body = cached
+    response = Response(body, status = status_code, content_type = content_type)
+    response.headers["X-Cache"] = "HIT"
+    return response
+
+@api.after_request
+def store_cached_response(response):
+    cache = response_caches.get((str(request.url_rule), request.method))
+    if cache is None or "X-Cache" in response.headers:
+        return response
+    if response.mimetype == "application/x-ndjson":
+        return response # Streams of every page are produced lazily and never buffered.
+
+    response.headers["X-Cache"] = "MISS"
+    if response.status_code == 200:
+        cache.set(
+            request.response_cache_key,
+            (response.status_code, response.content_type, response.get_data())
+        )
+    return response
+
+@api.after_request
+def invalidate_after_mutation(response):
+    '''Drops cached reads of a library's videos once a request through this proxy has changed them.'''
+    metadata = getattr(request, "metadata", None) or {}
+    if request.method in ("GET", "HEAD", "OPTIONS") or not metadata.get("mutates", True) or response.status_code >= 400:
+        return response
+    libraryId = (request.view_args or {}).get("libraryId")
+    if libraryId is not None:
+        invalidate_video(libraryId, request.view_args.get("videoId"))
+        if request.method == "DELETE" and "videoId" in request.view_args:
+            Catalog.mirror.remove_video(libraryId, request.view_args["videoId"])
+    return response
+
+def invalidate_video(libraryId: str, videoId: str = None) -> int:
+    '''
+    Drops the cached responses that depend on a video in this process, and through `Invalidation.journal` in the other
+    workers. Returns the number of entries dropped here.
+    '''
+    dropped = drop_cached_video(libraryId, videoId)
+    Invalidation.journal.publish(libraryId, videoId)
+    return dropped
+
+def drop_cached_video(libraryId: str, videoId: str = None) -> int:
+    '''
+    Drops this process's cached responses that depend on a video: its own reads, its play data and the library's video
+    listings. Without `videoId` only the listings are dropped. Returns the number of entries dropped.
+    '''
+    listing_path = f"/library/{libraryId}/videos"
+    video_path = f"{listing_path}/{videoId}"
+    def depends_on_video(key) -> bool:
+        path = key[0]
+        return path == listing_path or (videoId is not None and (path == video_path or path.startswith(video_path + "/")))
+
+    dropped = sum(cache.invalidate_where(depends_on_video) for cache in response_caches.values())
+    if videoId is not None:
+        Routes.video_heatmaps.pop((libraryId, videoId))
+    return dropped
+
+Events.hub.on_change = invalidate_video
+Jobs.runner.on_change = invalidate_video
+Invalidation.journal.on_invalidate = drop_cached_video
+
+@api.route('/webhooks/bunny', methods=["POST"], endpoint='bunny_webhook')
+def bunny_webhook():
+    '''
+    Intake for Bunny Stream video status callbacks (`{"VideoLibraryId", "VideoGuid", "Status"}`).
+    Everything cached about the video is dropped, its catalog mirror row is fetched again and its event stream polls at once.
+    '''
+    if WEBHOOK_SECRET is not None:
+        secret = request.args.get("secret") or request.headers.get("X-Webhook-Secret") or ""
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            return make_response(jsonify("Invalid webhook secret"), 401)
+
+    event = request.get_json(silent = True) or {}
+    libraryId = event.get("VideoLibraryId")
+    videoId = event.get("VideoGuid")
+    if libraryId is None or not videoId:
+        return make_response(jsonify("Webhook events must carry VideoLibraryId and VideoGuid"), 400)
+    libraryId = str(libraryId)
+
+    dropped = invalidate_video(libraryId, videoId)
+    Events.hub.wake(libraryId, videoId)
+    Catalog.mirror.refresh_video(libraryId, videoId)
+    return jsonify({"invalidated": dropped})
 
 for route in api_routes:
+    for method in route['methods']:
+        if (route['rule'], method) in route_metadata:
+            raise Exception(f"Multiple routes found in api_routes for rule {route['rule']} and method {method}")
+        route_metadata[(route['rule'], method)] = route.get('metadata')
+
+        circuit_config = (route['metadata'].get('upstream') or {}).get('circuit')
+        if circuit_config and not circuit_config.get('per_route'):
+            # Host breakers are shared by every route, so only the first route to call a host would get its settings.
+            raise Exception(f"The circuit settings of rule {route['rule']} must set per_route to override the breaker defaults")
+
+        cache_config = route['metadata'].get('cache')
+        if cache_config is not None:
+            response_caches[(route['rule'], method)] = Caching.TTLCache(
+                maxsize = cache_config.get('maxsize', 128),
+                ttl = cache_config['ttl']
+            )
+
     rule = route.copy() # This is *not* a reference to the item in api_routes.
     rule.pop("metadata") # Do not include the metadata as a kwarg.
     api.add_url_rule(**rule)
 
+Health.prober.ensure_running()
+Catalog.mirror.ensure_running()
+Jobs.runner.ensure_running()
+Invalidation.journal.ensure_running()
+
 if __name__ == "__main__":
     api.run('127.0.0.1', 5001, debug = True)
 
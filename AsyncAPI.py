@@ -0,0 +1,581 @@
+"""
+ASGI entry point serving the same `api_routes` table as `API.py` without blocking on Bunny.
+
+Run it with `uvicorn AsyncAPI:app` or `gunicorn -k uvicorn.workers.UvicornWorker AsyncAPI:app`.
+
+Routes are dispatched through the regular Flask application, so metadata, response mapping and
+hooks are shared with the sync engine. Whenever route code asks `Routes.make_api_request` for a
+response it doesn't have yet, the call is performed on the event loop with `httpx` and the route
+is replayed with the response available; a route making N upstream calls is replayed N times.
+Route code itself runs on worker threads, and pass-through bodies are streamed from Bunny as they are sent.
+Blocking routes and bodies produced while they are sent run on their own `BUNNY_ASYNC_BLOCKING_THREADS` executor,
+so long uploads and streams never starve the replays of other requests.
+Event streams wait for their events on the event loop, so idle subscribers don't hold a worker thread.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import io
+import json
+import sys
+import time
+from os import environ
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.structures import CaseInsensitiveDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import ClosingIterator
+
+import API
+import Events
+import Resilience
+import Routes
+import Throttling
+from API import api
+
+MAX_CONNECTIONS = int(environ.get('BUNNY_ASYNC_MAX_CONNECTIONS', 1000))       # In-flight upstream calls per process.
+MAX_KEEPALIVE = int(environ.get('BUNNY_ASYNC_MAX_KEEPALIVE', 100))           # Idle connections kept open per process.
+KEEPALIVE_EXPIRY = float(environ.get('BUNNY_ASYNC_KEEPALIVE_EXPIRY', 60))
+BLOCKING_THREADS = int(environ.get('BUNNY_ASYNC_BLOCKING_THREADS', 64))     # Threads for blocking routes and lazy bodies per process.
+
+_client = None
+_blocking_executor = None
+_inflight = {} # (method, url, AccessKey) -> asyncio.Task, for upstream calls of routes with "coalesce" metadata.
+
+
+def get_client() -> httpx.AsyncClient:
+    '''Returns this process's shared `httpx.AsyncClient`, creating it on first use.'''
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits = httpx.Limits(
+                max_connections = MAX_CONNECTIONS,
+                max_keepalive_connections = MAX_KEEPALIVE,
+                keepalive_expiry = KEEPALIVE_EXPIRY
+            ),
+            timeout = None
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_blocking_executor() -> concurrent.futures.ThreadPoolExecutor:
+    '''
+    Returns this process's executor for blocking routes and lazy bodies, creating it on first use. They hold a thread
+    for as long as an upload or a stream lasts, so they are kept off the default executor that route replays run on.
+    '''
+    global _blocking_executor
+    if _blocking_executor is None:
+        _blocking_executor = concurrent.futures.ThreadPoolExecutor(max_workers = BLOCKING_THREADS, thread_name_prefix = "blocking")
+    return _blocking_executor
+
+
+def close_blocking_executor() -> None:
+    global _blocking_executor
+    if _blocking_executor is not None:
+        _blocking_executor.shutdown(wait = False)
+        _blocking_executor = None
+
+
+async def run_blocking(func, *args):
+    '''`asyncio.to_thread` on the blocking executor.'''
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(get_blocking_executor(), call)
+
+
+async def fetch(call: Routes.UpstreamCall):
+    '''
+    Performs an upstream call captured from route code under its policy, mirroring `Routes.send_api_request`:
+    idempotent calls are retried with jittered backoff and hedged GETs race a second attempt after the route's p95.
+    '''
+    attempts = call.policy.attempts(call.method)
+    for attempt in range(attempts):
+        hedge_after = call.policy.hedge_delay(call.method)
+        if hedge_after is not None:
+            response = await fetch_hedged(call, hedge_after)
+        else:
+            response = await fetch_once(call)
+
+        if attempt == attempts - 1:
+            return response
+        if isinstance(response, requests.RequestException):
+            if not isinstance(response, (requests.ConnectionError, requests.Timeout)):
+                return response
+        elif response.status_code not in Resilience.RETRYABLE_STATUS_CODES:
+            return response
+        else:
+            await discard(response)
+        await asyncio.sleep(call.policy.backoff_delay(attempt))
+
+
+async def fetch_hedged(call: Routes.UpstreamCall, delay: float):
+    '''Sends a second attempt if the first hasn't answered within `delay` seconds; the first successful reply wins.'''
+    # Racing attempts are read in full, so that "first" means the first complete reply.
+    primary = asyncio.ensure_future(fetch_once(call, stream = False))
+    done, _ = await asyncio.wait({primary}, timeout = delay)
+    if done:
+        return primary.result()
+
+    secondary = asyncio.ensure_future(fetch_once(call, stream = False))
+    done, pending = await asyncio.wait({primary, secondary}, return_when = asyncio.FIRST_COMPLETED)
+    # Both attempts may finish within the same wait, in which case one that didn't fail is preferred.
+    winner = sorted(done, key = lambda task: task.exception() is not None or isinstance(task.result(), requests.RequestException))[0]
+    if (winner.exception() is not None or isinstance(winner.result(), requests.RequestException)) and pending:
+        return await pending.pop()
+    for loser in pending:
+        loser.cancel()
+    return winner.result()
+
+
+class UpstreamBodyStream(io.RawIOBase):
+    '''
+    Body of a streamed upstream response, read by route code on a worker thread while `httpx` receives it on the event loop.
+    This is what lets pass-through routes forward large bodies under the async engine without buffering them.
+    '''
+    def __init__(self, upstream: httpx.Response, loop: asyncio.AbstractEventLoop) -> None:
+        self._upstream = upstream
+        self._chunks = upstream.aiter_bytes()
+        self._loop = loop
+        self._buffer = b""
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._done:
+            try:
+                self._buffer = asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+            except StopAsyncIteration:
+                self._done = True
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    async def aclose(self) -> None:
+        await self._upstream.aclose()
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is self._loop:
+                self._loop.create_task(self.aclose())
+            elif not self._loop.is_closed():
+                asyncio.run_coroutine_threadsafe(self.aclose(), self._loop)
+        super().close()
+
+
+async def discard(response: requests.Response) -> None:
+    '''Releases the connection of a response nobody will read, such as one that is about to be retried.'''
+    if isinstance(response.raw, UpstreamBodyStream):
+        await response.raw.aclose()
+
+
+async def fetch_once(call: Routes.UpstreamCall, stream: bool = None):
+    '''
+    Performs one attempt of an upstream call and wraps the result as a `requests.Response`.
+    Streamed calls leave the body on the connection behind an `UpstreamBodyStream`; others are read in full.
+    Transport failures are returned as the equivalent `requests` exception, which the replayed route then raises.
+    '''
+    stream = call.stream if stream is None else stream
+    content = call.data if isinstance(call.data, (bytes, str)) else None
+    form = call.data if isinstance(call.data, dict) else None
+    access_key = call.headers["AccessKey"]
+
+    try:
+        delay = Routes.upstream_scheduler.reserve(access_key, urlsplit(call.url).netloc)
+    except Throttling.UpstreamThrottled as e:
+        return e
+    if delay > 0:
+        with Routes.upstream_scheduler.waiting():
+            await asyncio.sleep(delay)
+
+    breaker = call.policy.breaker(call.url)
+    try:
+        breaker.before_call()
+    except Resilience.CircuitOpen as e:
+        return e
+
+    started = time.monotonic()
+    try:
+        client = get_client()
+        upstream = await client.send(
+            client.build_request(
+                call.method, call.url,
+                headers = call.headers, content = content or None, data = form, json = call.json,
+                timeout = httpx.Timeout(call.policy.read_timeout, connect = call.policy.connect_timeout)
+            ),
+            stream = stream
+        )
+    except httpx.TimeoutException as e:
+        breaker.after_call(True, time.monotonic() - started)
+        return requests.Timeout(str(e))
+    except httpx.TransportError as e:
+        breaker.after_call(True, time.monotonic() - started)
+        return requests.ConnectionError(str(e))
+    except BaseException:
+        # Cancelled (e.g. a losing hedge) or failed before Bunny answered: the half-open probe slot must be given back.
+        breaker.abandon_call()
+        raise
+
+    elapsed = time.monotonic() - started
+    breaker.after_call(upstream.status_code >= 500, elapsed)
+    Resilience.latencies.record(call.policy.name, elapsed)
+    Routes.upstream_scheduler.record_response(access_key, upstream.status_code, upstream.headers.get("Retry-After"))
+
+    response = requests.Response()
+    response.status_code = upstream.status_code
+    response.reason = upstream.reason_phrase
+    response.headers = CaseInsensitiveDict(upstream.headers)
+    response.url = call.url
+    if stream:
+        response.raw = UpstreamBodyStream(upstream, asyncio.get_running_loop())
+        return response
+    # Mark the body as already read so coalesced requests sharing this response can each iterate it.
+    response._content = upstream.content
+    response._content_consumed = True
+    response.raw = io.BytesIO()
+    return response
+
+
+async def fetch_coalesced(call: Routes.UpstreamCall) -> requests.Response:
+    '''Shares one in-flight upstream call between identical requests, falling back to a private call after `coalesce_timeout`.'''
+    call.stream = False # Every waiting request forwards the same body, so it must be read in full.
+    key = (call.method, call.url, call.headers.get("AccessKey"))
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch(call))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+        return await task
+
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), call.coalesce_timeout)
+    except asyncio.TimeoutError:
+        return await fetch(call)
+
+
+class ReceiveStream(io.RawIOBase):
+    '''
+    WSGI input that pulls the ASGI request body from the event loop as it is read, for routes run on a worker thread.
+    Nothing is buffered beyond the last message received, so uploads stream through in constant memory.
+    '''
+    def __init__(self, receive, loop: asyncio.AbstractEventLoop) -> None:
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b""
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._done:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message["type"] == "http.disconnect":
+                self._done = True
+                break
+            self._buffer = message.get("body", b"")
+            self._done = not message.get("more_body", False)
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def build_environ(scope: dict, body: bytes, wsgi_input = None) -> dict:
+    '''
+    Builds a WSGI environ for an ASGI HTTP scope whose body has already been received,
+    or that is read from `wsgi_input` with the client's Content-Length when one is given.
+    '''
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    wsgi_environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)) if wsgi_input is None else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body) if wsgi_input is None else wsgi_input,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-type":
+            wsgi_environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            if wsgi_input is not None:
+                wsgi_environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            wsgi_environ[key] = f"{wsgi_environ[key]},{value}" if key in wsgi_environ else value
+    return wsgi_environ
+
+
+def replay(wsgi_environ: dict, prefetched: dict):
+    '''
+    Runs the Flask application once with the upstream responses known so far, on a worker thread.
+    Returns the WSGI status, headers and body iterable, or the `Routes.UpstreamRequest` for the calls it still needs.
+    '''
+    started = {}
+    def start_response(status, headers, exc_info = None):
+        started["status"] = status
+        started["headers"] = headers
+
+    token = Routes.upstream_replay.set(prefetched)
+    try:
+        body_iterable = api.wsgi_app(wsgi_environ, start_response)
+        return started["status"], started["headers"], body_iterable
+    except Routes.UpstreamRequest as pending:
+        return pending
+    finally:
+        Routes.upstream_replay.reset(token)
+
+
+async def dispatch(make_environ):
+    '''
+    Runs the Flask application for one request, performing its upstream calls on the event loop.
+    Route code runs on a worker thread, so a slow route never holds up other connections.
+    `make_environ` returns a fresh WSGI environ for every replay. Returns the WSGI status, headers and body iterable,
+    and whether the body must be iterated off the event loop because it streams an upstream body.
+    '''
+    prefetched = {}
+    while True:
+        wsgi_environ = make_environ()
+        outcome = await asyncio.to_thread(replay, wsgi_environ, prefetched)
+        if not isinstance(outcome, Routes.UpstreamRequest):
+            status, headers, body_iterable = outcome
+            event_stream = wsgi_environ.get(Events.EVENTS_ENVIRON_KEY)
+            if event_stream is not None:
+                return status, headers, EventLoopBody(event_stream, body_iterable), False
+            streamed = [
+                response for response in prefetched.values()
+                if isinstance(response, requests.Response) and isinstance(response.raw, UpstreamBodyStream)
+            ]
+            # Streamed responses the route didn't hand on (e.g. one rejected with a 401) are closed along with the body.
+            return status, headers, ClosingIterator(body_iterable, [response.close for response in streamed]), bool(streamed)
+
+        semaphore = asyncio.Semaphore(outcome.max_concurrency or len(outcome.calls))
+        async def perform(call):
+            async with semaphore:
+                if call.coalesce_timeout is not None:
+                    return await fetch_coalesced(call)
+                return await fetch(call)
+        responses = await asyncio.gather(*[perform(call) for call in outcome.calls])
+        for call, response in zip(outcome.calls, responses):
+            prefetched[call.key] = response
+
+
+class EventLoopBody:
+    '''A WSGI body produced by `async for` over `chunks` instead; closing it closes the WSGI body, which closes `chunks`.'''
+
+    def __init__(self, chunks, body_iterable) -> None:
+        self.chunks = chunks
+        self.body_iterable = body_iterable
+
+    def __aiter__(self):
+        return self.chunks.__aiter__()
+
+    def close(self) -> None:
+        if hasattr(self.body_iterable, "close"):
+            self.body_iterable.close()
+
+
+def is_lazy_body(headers: list, streamed: bool) -> bool:
+    '''
+    True for bodies that must be iterated off the event loop: streamed upstream bodies, and NDJSON bodies, which may call
+    upstream while they are produced.
+    '''
+    return streamed or any(
+        name.lower() == "content-type" and value.startswith("application/x-ndjson")
+        for name, value in headers
+    )
+
+
+def is_blocking_route(wsgi_environ: dict) -> bool:
+    '''True for routes whose metadata marks them "blocking": they orchestrate their own upstream calls and must run off the event loop.'''
+    try:
+        rule, _ = api.url_map.bind_to_environ(wsgi_environ).match(return_rule = True)
+    except HTTPException:
+        return False
+    metadata = API.route_metadata.get((rule.rule, wsgi_environ["REQUEST_METHOD"])) or {}
+    return metadata.get("blocking", False)
+
+
+async def dispatch_blocking(wsgi_environ: dict):
+    '''
+    Runs a "blocking" route on the blocking executor with the sync engine, returning the WSGI status, headers and body iterable,
+    which is always iterated off the event loop.
+    '''
+    started = {}
+    def start_response(status, headers, exc_info = None):
+        started["status"] = status
+        started["headers"] = headers
+
+    body_iterable = await run_blocking(api.wsgi_app, wsgi_environ, start_response)
+    return started["status"], started["headers"], body_iterable, True
+
+
+async def dispatch_batch_item(item, semaphore: asyncio.Semaphore) -> dict:
+    try:
+        API.batch_item_environ(item)
+    except ValueError as e:
+        return {"status": 400, "body": str(e)}
+
+    async with semaphore:
+        status, headers, body_iterable, streamed = await dispatch(lambda: API.batch_item_environ(item))
+        try:
+            body = await run_blocking(b"".join, body_iterable) if is_lazy_body(headers, streamed) else b"".join(body_iterable)
+        finally:
+            if hasattr(body_iterable, "close"):
+                body_iterable.close()
+    return API.batch_item_result(status, headers, body)
+
+
+async def dispatch_batch(scope: dict, body: bytes):
+    '''Event-loop counterpart of `API.batch`: sub-requests are dispatched concurrently, bounded by the same per-batch cap.'''
+    try:
+        items = API.parse_batch_items(json.loads(body or b"null"))
+    except ValueError as e:
+        return 400, {"error": str(e)}
+
+    query = dict(pair.split("=", 1) for pair in scope.get("query_string", b"").decode("latin-1").split("&") if "=" in pair)
+    semaphore = asyncio.Semaphore(API.batch_concurrency(query.get("concurrency")))
+    results = await asyncio.gather(*[dispatch_batch_item(item, semaphore) for item in items])
+    return 200, {"results": list(results)}
+
+
+async def receive_body(receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    return bytes(body)
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            get_client()
+            get_blocking_executor()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_client()
+            close_blocking_executor()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    # Blocking routes read their body on the worker thread as they go, everything else is dispatched with it in hand.
+    blocking = is_blocking_route(build_environ(scope, b""))
+    if blocking:
+        wsgi_input = ReceiveStream(receive, asyncio.get_running_loop())
+        status, headers, body_iterable, lazy = await dispatch_blocking(build_environ(scope, b"", wsgi_input = wsgi_input))
+        await send_response(send, status, headers, body_iterable, lazy = lazy)
+        return
+
+    body = await receive_body(receive)
+    if scope["method"] == "POST" and scope["path"].rstrip("/") == "/batch":
+        status_code, document = await dispatch_batch(scope, body)
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(b"content-type", b"application/json")]
+        })
+        await send({"type": "http.response.body", "body": json.dumps(document).encode()})
+        return
+
+    status, headers, body_iterable, streamed = await dispatch(lambda: build_environ(scope, body))
+    await send_response(send, status, headers, body_iterable, lazy = is_lazy_body(headers, streamed), receive = receive)
+
+
+async def wait_for_disconnect(receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_response(send, status: str, headers: list, body_iterable, lazy: bool, receive = None) -> None:
+    '''
+    Sends a WSGI response over ASGI; `lazy` bodies are iterated on the blocking executor.
+    An `EventLoopBody` is iterated on the event loop until it ends or, given `receive`, the client disconnects.
+    '''
+    await send({
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+    })
+    if isinstance(body_iterable, EventLoopBody):
+        await send_event_loop_body(send, body_iterable, receive)
+        return
+    iterator = iter(body_iterable)
+    try:
+        while True:
+            chunk = await run_blocking(next, iterator, None) if lazy else next(iterator, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        if hasattr(body_iterable, "close"):
+            body_iterable.close()
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def send_event_loop_body(send, body: EventLoopBody, receive) -> None:
+    async def send_chunks():
+        async for chunk in body:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    tasks = [asyncio.ensure_future(send_chunks())]
+    if receive is not None:
+        tasks.append(asyncio.ensure_future(wait_for_disconnect(receive)))
+    try:
+        done, pending = await asyncio.wait(tasks, return_when = asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions = True)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        body.close()
@@ -0,0 +1,75 @@
+"""
+Per-process daemon threads, per-thread SQLite connections and the token naming this process in shared databases, used by
+the upstream prober, the catalog mirror, the job runner and the other background services. All are keyed by PID: none survive a gunicorn fork.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import uuid
+
+_process_token = None
+
+
+def process_token() -> str:
+    '''Names this process in shared databases; the random part keeps a later process that reuses the PID from passing for it.'''
+    global _process_token
+    if _process_token is None or not _process_token.startswith(f"{socket.gethostname()}:{os.getpid()}:"):
+        _process_token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    return _process_token
+
+
+class ProcessThread:
+    '''A daemon thread running `target` in every process that asks for it, started again after a fork or if it died.'''
+
+    def __init__(self, target, name: str, on_start = None) -> None:
+        self.target = target
+        self.name = name
+        self.on_start = on_start # Called under the lock before each start, to reset state inherited from the parent process.
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._pid == os.getpid() and self._thread is not None and self._thread.is_alive()
+
+    def ensure_running(self) -> None:
+        if self.running:
+            return
+        with self._lock:
+            if self.running:
+                return
+            self._pid = os.getpid()
+            if self.on_start is not None:
+                self.on_start()
+            self._thread = threading.Thread(target = self.target, name = self.name, daemon = True)
+            self._thread.start()
+
+
+class SQLiteConnections:
+    '''
+    One WAL-mode connection to `path` per thread and process; the schema is created by whichever connects first.
+    `on_connect` is called with every new connection once the schema exists, e.g. to add columns to older databases.
+    '''
+
+    def __init__(self, path: str, schema: str, pragmas: tuple = (), on_connect = None) -> None:
+        self.path = path
+        self.schema = schema
+        self.pragmas = pragmas
+        self.on_connect = on_connect
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            for pragma in self.pragmas:
+                connection.execute(f"PRAGMA {pragma}")
+            connection.executescript(self.schema)
+            if self.on_connect is not None:
+                self.on_connect(connection)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
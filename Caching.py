@@ -0,0 +1,243 @@
+"""
+In-process caching primitives shared by the proxy routes.
+"""
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''
+    Bounded, thread-safe mapping whose entries expire after `ttl` seconds.
+    Once `maxsize` entries are held, the least recently used entry is evicted.
+    '''
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        '''Returns the live value for `key`, or `default` if it is missing or expired.'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_stale(self, key, default = None):
+        '''Returns the value for `key` even if it has expired, as long as it hasn't been evicted or popped.'''
+        with self._lock:
+            entry = self._data.get(key)
+        return default if entry is None else entry[1]
+
+    def set(self, key, value, ttl: float = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+
+    def pop(self, key, default = None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def invalidate_where(self, predicate) -> int:
+        '''Drops every entry whose key matches `predicate(key)`, returning how many were dropped.'''
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class DailySeriesStore:
+    '''
+    Daily time series (documents of `{"<chart>": {"<ISO date>": value}}`) per owner, filled in incrementally.
+    Days older than the `open_days` trailing window are final once stored; days inside it are always fetched again.
+    '''
+    def __init__(self, open_days: int) -> None:
+        self.open_days = open_days
+        self._charts = {}      # owner -> chart -> date -> (original key, value)
+        self._closed_days = {} # owner -> set of final dates
+        self._lock = threading.Lock()
+
+    def missing_runs(self, owner, first: datetime.date, last: datetime.date, today: datetime.date) -> list:
+        '''Contiguous (first, last) date ranges between `first` and `last` that must be fetched upstream.'''
+        closed_days = self._closed_days.get(owner, set())
+        open_from = today - datetime.timedelta(days = self.open_days)
+        one_day = datetime.timedelta(days = 1)
+        runs = []
+        day = first
+        while day <= last:
+            if day not in closed_days or day >= open_from:
+                if runs and runs[-1][1] + one_day == day:
+                    runs[-1] = (runs[-1][0], day)
+                else:
+                    runs.append((day, day))
+            day += one_day
+        return runs
+
+    def store(self, owner, first: datetime.date, last: datetime.date, document: dict, today: datetime.date) -> None:
+        '''Stores the points of a document fetched for `first`..`last`, marking the days before the open window as final.'''
+        open_from = today - datetime.timedelta(days = self.open_days)
+        with self._lock:
+            charts = self._charts.setdefault(owner, {})
+            for chart, points in document.items():
+                if not isinstance(points, dict):
+                    continue
+                series = charts.setdefault(chart, {})
+                for key, value in points.items():
+                    try:
+                        day = datetime.date.fromisoformat(key[:10])
+                    except ValueError:
+                        continue
+                    if first <= day <= last:
+                        series[day] = (key, value)
+            closed_days = self._closed_days.setdefault(owner, set())
+            day = first
+            while day <= last and day < open_from:
+                closed_days.add(day)
+                day += datetime.timedelta(days = 1)
+
+    def assemble(self, owner, first: datetime.date, last: datetime.date) -> dict:
+        '''Builds a document with every chart's stored points between `first` and `last`, in date order.'''
+        with self._lock:
+            return {
+                chart: dict(series[day] for day in sorted(series) if first <= day <= last)
+                for chart, series in self._charts.get(owner, {}).items()
+            }
+
+    def stats(self) -> dict:
+        return {
+            "owners": len(self._charts),
+            "closed_days": sum(len(days) for days in self._closed_days.values()),
+            "open_days": self.open_days
+        }
+
+
+class DailyDocumentStore:
+    '''
+    One document per owner and day, for upstream reports whose range totals can't be split into days after the fact.
+    Days older than the `open_days` trailing window are final once stored; days inside it are kept for `open_ttl` seconds.
+    '''
+    def __init__(self, open_days: int, open_ttl: float) -> None:
+        self.open_days = open_days
+        self.open_ttl = open_ttl
+        self.hits = 0
+        self.misses = 0
+        self._days = {} # owner -> date -> (expires_at or None when final, document)
+        self._lock = threading.Lock()
+
+    def missing_days(self, owner, first: datetime.date, last: datetime.date) -> list:
+        '''The days between `first` and `last` that have no live document and must be fetched upstream.'''
+        now = time.monotonic()
+        with self._lock:
+            days = self._days.get(owner, {})
+            missing = []
+            day = first
+            while day <= last:
+                entry = days.get(day)
+                if entry is None or (entry[0] is not None and entry[0] <= now):
+                    missing.append(day)
+                day += datetime.timedelta(days = 1)
+            self.misses += len(missing)
+            self.hits += (last - first).days + 1 - len(missing)
+        return missing
+
+    def store(self, owner, day: datetime.date, document, today: datetime.date) -> None:
+        final = day < today - datetime.timedelta(days = self.open_days)
+        with self._lock:
+            self._days.setdefault(owner, {})[day] = (None if final else time.monotonic() + self.open_ttl, document)
+
+    def assemble(self, owner, first: datetime.date, last: datetime.date) -> list:
+        '''The stored documents between `first` and `last`, in date order.'''
+        with self._lock:
+            days = self._days.get(owner, {})
+            return [days[day][1] for day in sorted(days) if first <= day <= last]
+
+    def stats(self) -> dict:
+        return {
+            "owners": len(self._days),
+            "final_days": sum(1 for days in self._days.values() for entry in days.values() if entry[0] is None),
+            "open_days": self.open_days,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Collapses concurrent calls for the same key into one execution.
+    The first caller runs the function; everyone else arriving while it is in flight waits for its result.
+    '''
+    def __init__(self) -> None:
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout: float = None):
+        '''
+        Runs `func()` once for all concurrent callers sharing `key` and returns its result (or raises its exception).
+        Followers that wait longer than `timeout` seconds give up and call `func()` themselves.
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                return func()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+        except BaseException as e:
+            # Includes `Routes.UpstreamRequest` from the async engine: followers must replay it too, not read a `None` result.
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return flight.result
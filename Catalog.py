@@ -0,0 +1,368 @@
+"""
+Optional local mirror of each library's video catalog in SQLite, so searches never wait on Bunny.
+
+The mirror is enabled by setting `BUNNY_CATALOG_PATH`, and only the libraries listed in `BUNNY_CATALOG_LIBRARIES` are
+mirrored, so clients can't make the proxy copy any library they name. One process at a time runs the sync thread
+(elected through a lock file), every process serves queries from the shared database.
+"""
+import fcntl
+import json
+import math
+import sqlite3
+import time
+from os import environ
+from urllib.parse import urlencode
+
+from flask import request, make_response, jsonify, Response
+
+import Background
+import Routes
+
+CATALOG_PATH = environ.get('BUNNY_CATALOG_PATH')                                       # Unset disables the mirror.
+CATALOG_LIBRARIES = [libraryId.strip() for libraryId in environ.get('BUNNY_CATALOG_LIBRARIES', '').split(',') if libraryId.strip()]
+CATALOG_SYNC_INTERVAL = float(environ.get('BUNNY_CATALOG_SYNC_INTERVAL', 60))          # Seconds between incremental syncs.
+CATALOG_FULL_SYNC_INTERVAL = float(environ.get('BUNNY_CATALOG_FULL_SYNC_INTERVAL', 3600)) # Seconds between full syncs, which also catch edits & deletions.
+CATALOG_STALE_AFTER = float(environ.get('BUNNY_CATALOG_STALE_AFTER', 3 * CATALOG_SYNC_INTERVAL))
+CATALOG_MAX_PAGE_SIZE = 1000
+CATALOG_SCHEMA_VERSION = 1 # Stored as the database's user_version once the search index covers every row.
+
+FINAL_STATUSES = (4, 5, 6) # Finished, error & upload failed: videos in any other status are still changing.
+
+ORDER_COLUMNS = {
+    "date": "date_uploaded",
+    "title": "title COLLATE NOCASE",
+    "views": "views",
+    "length": "length"
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    library_id TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    title TEXT,
+    date_uploaded TEXT,
+    views INTEGER,
+    length INTEGER,
+    status INTEGER,
+    collection_id TEXT,
+    document TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (library_id, guid)
+);
+CREATE INDEX IF NOT EXISTS videos_date ON videos (library_id, date_uploaded);
+CREATE INDEX IF NOT EXISTS videos_title ON videos (library_id, title COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS videos_views ON videos (library_id, views);
+CREATE INDEX IF NOT EXISTS videos_length ON videos (library_id, length);
+CREATE INDEX IF NOT EXISTS videos_status ON videos (library_id, status);
+CREATE VIRTUAL TABLE IF NOT EXISTS videos_search USING fts5(
+    title, content = 'videos', content_rowid = 'rowid', tokenize = 'trigram'
+);
+CREATE TRIGGER IF NOT EXISTS videos_search_insert AFTER INSERT ON videos BEGIN
+    INSERT INTO videos_search (rowid, title) VALUES (new.rowid, new.title);
+END;
+CREATE TRIGGER IF NOT EXISTS videos_search_delete AFTER DELETE ON videos BEGIN
+    INSERT INTO videos_search (videos_search, rowid, title) VALUES ('delete', old.rowid, old.title);
+END;
+CREATE TRIGGER IF NOT EXISTS videos_search_update AFTER UPDATE OF title ON videos BEGIN
+    INSERT INTO videos_search (videos_search, rowid, title) VALUES ('delete', old.rowid, old.title);
+    INSERT INTO videos_search (rowid, title) VALUES (new.rowid, new.title);
+END;
+CREATE TABLE IF NOT EXISTS libraries (
+    library_id TEXT PRIMARY KEY,
+    last_sync REAL,
+    last_full_sync REAL,
+    high_water TEXT,
+    last_error TEXT
+);
+"""
+
+
+class CatalogMirror:
+    '''Keeps the SQLite mirror in sync with Bunny from a daemon thread and answers catalog queries from it.'''
+
+    def __init__(self, path: str, libraries: list, interval: float, full_interval: float, stale_after: float) -> None:
+        self.path = path
+        self.libraries = libraries
+        self.interval = interval
+        self.full_interval = full_interval
+        self.stale_after = stale_after
+        # Recursive triggers make the REPLACE of `store_videos` fire the delete trigger that keeps the search index in sync.
+        self._connections = Background.SQLiteConnections(path, SCHEMA, pragmas = ("synchronous = NORMAL", "recursive_triggers = ON"))
+        self._thread = Background.ProcessThread(self._run, name = "catalog-sync", on_start = self._on_start)
+        self._lock_file = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def ensure_running(self) -> None:
+        if self.enabled:
+            self._thread.ensure_running()
+
+    def _on_start(self) -> None:
+        self._lock_file = None # A forked child doesn't hold its parent's sync lock.
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        if connection.execute("PRAGMA user_version").fetchone()[0] < CATALOG_SCHEMA_VERSION:
+            # Databases mirrored before the search index existed have rows it doesn't cover yet.
+            connection.execute("INSERT INTO videos_search (videos_search) VALUES ('rebuild')")
+            connection.execute(f"PRAGMA user_version = {CATALOG_SCHEMA_VERSION}")
+        connection.execute("COMMIT")
+        for libraryId in self.libraries:
+            self.register(libraryId)
+
+    def register(self, libraryId: str) -> None:
+        '''Adds a library to the mirror; the process running the sync picks it up on its next pass.'''
+        self._connection().execute("INSERT OR IGNORE INTO libraries (library_id) VALUES (?)", (libraryId,))
+
+    def mirrors(self, libraryId: str) -> bool:
+        '''True for the libraries the operator configured; rows of others, registered by older versions, are ignored.'''
+        return self.enabled and libraryId in self.libraries
+
+    def _is_sync_leader(self) -> bool:
+        '''True when this process holds the sync lock, so that several workers don't all sync the same database.'''
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self) -> None:
+        while True:
+            if self._is_sync_leader():
+                rows = self._connection().execute("SELECT library_id, last_full_sync FROM libraries").fetchall()
+                for libraryId, last_full_sync in rows:
+                    if not self.mirrors(libraryId):
+                        continue
+                    full = last_full_sync is None or time.time() - last_full_sync >= self.full_interval
+                    try:
+                        self.sync_library(libraryId, full = full)
+                    except Exception as e:
+                        self._connection().execute(
+                            "UPDATE libraries SET last_error = ? WHERE library_id = ?", (f"{type(e).__name__}: {e}", libraryId)
+                        )
+            time.sleep(self.interval)
+
+    def fetch_page(self, libraryId: str, api_key: str, page: int) -> dict:
+        bunny_api_response = Routes.make_api_request(
+            url = f"https://video.bunnycdn.com/library/{libraryId}/videos?" + urlencode({
+                "page": page,
+                "itemsPerPage": Routes.PAGINATION_PAGE_SIZE,
+                "orderBy": "date"
+            }),
+            method = "GET",
+            headers = {
+                "AccessKey": api_key
+            },
+            stream = False
+        )
+        if bunny_api_response.status_code == 401:
+            Routes.invalidate_library_api_key(libraryId)
+        if bunny_api_response.status_code != 200:
+            raise RuntimeError(f"ListVideos answered {bunny_api_response.status_code}")
+        return bunny_api_response.json()
+
+    def sync_library(self, libraryId: str, full: bool) -> None:
+        '''
+        Pages through `ListVideos` newest first into the mirror. A full sync reads every page and drops videos that no
+        longer exist; an incremental one stops at the newest upload seen last time and refreshes videos still processing.
+        '''
+        connection = self._connection()
+        started = time.time()
+        high_water = connection.execute("SELECT high_water FROM libraries WHERE library_id = ?", (libraryId,)).fetchone()[0]
+        api_key = Routes.retrieve_library_api_key(libraryId)
+        if api_key is None:
+            raise RuntimeError("The library API key could not be retrieved")
+
+        newest = high_water
+        page = 1
+        while True:
+            body = self.fetch_page(libraryId, api_key, page)
+            items = body.get("items") or []
+            self.store_videos(libraryId, items, started)
+            for video in items:
+                if newest is None or (video.get("dateUploaded") or "") > newest:
+                    newest = video.get("dateUploaded")
+
+            if len(items) == 0 or page * Routes.PAGINATION_PAGE_SIZE >= body.get("totalItems", 0):
+                break
+            if not full and high_water is not None and min(video.get("dateUploaded") or "" for video in items) < high_water:
+                break
+            page += 1
+
+        if full:
+            connection.execute("DELETE FROM videos WHERE library_id = ? AND synced_at < ?", (libraryId, started))
+        else:
+            self.refresh_processing(libraryId, api_key, started)
+
+        connection.execute(
+            "UPDATE libraries SET last_sync = ?, high_water = ?, last_error = NULL" + (", last_full_sync = ?" if full else "") + " WHERE library_id = ?",
+            (started, newest, started, libraryId) if full else (started, newest, libraryId)
+        )
+
+    def refresh_processing(self, libraryId: str, api_key: str, synced_at: float) -> None:
+        '''Fetches the videos still being processed again, since their status changes without a new upload.'''
+        guids = [row[0] for row in self._connection().execute(
+            f"SELECT guid FROM videos WHERE library_id = ? AND status NOT IN ({', '.join('?' * len(FINAL_STATUSES))}) AND synced_at < ?",
+            (libraryId, *FINAL_STATUSES, synced_at)
+        )]
+        bunny_api_responses = Routes.make_api_requests(
+            [
+                {
+                    "url": f"https://video.bunnycdn.com/library/{libraryId}/videos/{guid}",
+                    "method": "GET",
+                    "headers": {
+                        "AccessKey": api_key
+                    }
+                }
+                for guid in guids
+            ],
+            max_workers = Routes.BULK_CONCURRENCY
+        )
+        fetched = [(guid, response) for guid, response in zip(guids, bunny_api_responses) if not isinstance(response, Exception)]
+        self.store_videos(libraryId, [response.json() for _, response in fetched if response.status_code == 200], synced_at)
+        for guid, response in fetched:
+            if response.status_code == 404:
+                self.remove_video(libraryId, guid)
+
+    def store_videos(self, libraryId: str, videos: list, synced_at: float) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        libraryId, video["guid"], video.get("title"), video.get("dateUploaded"), video.get("views"),
+                        video.get("length"), video.get("status"), video.get("collectionId"), json.dumps(video), synced_at
+                    )
+                    for video in videos if video.get("guid")
+                ]
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def refresh_video(self, libraryId: str, videoId: str) -> None:
+        '''Fetches one video of a mirrored library again, so its row reflects a change announced by a webhook.'''
+        if self.sync_state(libraryId) is None:
+            return
+        bunny_api_response = Routes.make_api_request(
+            url = f"https://video.bunnycdn.com/library/{libraryId}/videos/{videoId}",
+            method = "GET",
+            headers = {
+                "AccessKey": Routes.retrieve_library_api_key(libraryId)
+            },
+            stream = False
+        )
+        if bunny_api_response.status_code == 200:
+            self.store_videos(libraryId, [bunny_api_response.json()], time.time())
+        elif bunny_api_response.status_code == 404:
+            self.remove_video(libraryId, videoId)
+
+    def remove_video(self, libraryId: str, guid: str) -> None:
+        if not self.enabled:
+            return
+        self._connection().execute("DELETE FROM videos WHERE library_id = ? AND guid = ?", (libraryId, guid))
+
+    def sync_state(self, libraryId: str):
+        '''The library's sync bookkeeping, or `None` when it isn't mirrored.'''
+        if not self.mirrors(libraryId):
+            return None
+        row = self._connection().execute(
+            "SELECT last_sync, last_full_sync, last_error FROM libraries WHERE library_id = ?", (libraryId,)
+        ).fetchone()
+        if row is None:
+            return None
+        last_sync, last_full_sync, last_error = row
+        age = time.time() - last_sync if last_sync is not None else None
+        return {
+            "syncedAt": last_sync,
+            "fullSyncAt": last_full_sync,
+            "age": round(age, 1) if age is not None else None,
+            "stale": age is None or age > self.stale_after,
+            "error": last_error
+        }
+
+    def query(self, libraryId: str, search: str = None, collection: str = None, order_by: str = "date",
+              descending: bool = True, page: int = 1, per_page: int = 100) -> tuple:
+        '''
+        Returns the total number of matching videos and the stored JSON documents of the requested page.
+        Searches of three characters or more are answered by the trigram index; shorter ones can't use it and scan the library.
+        '''
+        where = "library_id = ?"
+        params = [libraryId]
+        if search and len(search) >= 3:
+            where += " AND rowid IN (SELECT rowid FROM videos_search WHERE videos_search MATCH ?)"
+            params.append('"' + search.replace('"', '""') + '"')
+        elif search:
+            where += " AND title LIKE ? ESCAPE '\\'"
+            params.append("%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if collection:
+            where += " AND collection_id = ?"
+            params.append(collection)
+
+        connection = self._connection()
+        total = connection.execute(f"SELECT COUNT(*) FROM videos WHERE {where}", params).fetchone()[0]
+        documents = [row[0] for row in connection.execute(
+            f"SELECT document FROM videos WHERE {where} ORDER BY {ORDER_COLUMNS[order_by]} {'DESC' if descending else 'ASC'}, guid LIMIT ? OFFSET ?",
+            params + [per_page, (page - 1) * per_page]
+        )]
+        return total, documents
+
+
+mirror = CatalogMirror(
+    CATALOG_PATH, CATALOG_LIBRARIES,
+    interval = CATALOG_SYNC_INTERVAL, full_interval = CATALOG_FULL_SYNC_INTERVAL, stale_after = CATALOG_STALE_AFTER
+)
+
+
+def SearchCatalog(libraryId):
+    '''
+    Searches, sorts and pages a library's videos from the local mirror, shaped like `ListVideos` plus a `catalog`
+    entry telling how fresh the mirror is. Stored documents are spliced into the response without being decoded.
+    '''
+    if not mirror.enabled:
+        return make_response(jsonify(request.metadata['responses'][404]), 404)
+
+    state = mirror.sync_state(libraryId)
+    if state is None:
+        return make_response(jsonify("This library isn't mirrored; add it to BUNNY_CATALOG_LIBRARIES"), 404)
+    if state["syncedAt"] is None:
+        api_response = make_response(jsonify(request.metadata['responses'][503]), 503)
+        api_response.headers["Retry-After"] = str(math.ceil(mirror.interval))
+        return api_response
+
+    page = request.args.get("page", 1, type = int)
+    per_page = request.args.get("itemsPerPage", 100, type = int)
+    order_by = request.args.get("orderBy", "date")
+    if page is None or page < 1 or per_page is None or not 1 <= per_page <= CATALOG_MAX_PAGE_SIZE:
+        return make_response(jsonify(f"page must be positive and itemsPerPage between 1 and {CATALOG_MAX_PAGE_SIZE}"), 400)
+    if order_by not in ORDER_COLUMNS:
+        return make_response(jsonify(f"orderBy must be one of {', '.join(ORDER_COLUMNS)}"), 400)
+
+    total, documents = mirror.query(
+        libraryId,
+        search = request.args.get("search"),
+        collection = request.args.get("collection"),
+        order_by = order_by,
+        descending = request.args.get("order", "desc") != "asc",
+        page = page,
+        per_page = per_page
+    )
+    body = (
+        f'{{"totalItems": {total}, "currentPage": {page}, "itemsPerPage": {per_page}, '
+        f'"catalog": {json.dumps(state)}, "items": [' + ", ".join(documents) + "]}"
+    )
+    api_response = Response(body, content_type = "application/json")
+    api_response.headers["X-Catalog-Age"] = str(state["age"])
+    return api_response
@@ -0,0 +1,396 @@
+"""
+Server-Sent Events for video encode progress, backed by one shared upstream poller per video.
+
+Each process keeps one `VideoPoller` per watched video for its subscribers, and the processes of a host elect one of them
+through `BUNNY_EVENTS_PATH` to actually poll Bunny; the others follow the events it stores there.
+Under the async engine, event streams are served from the event loop instead of holding a worker thread per subscriber.
+"""
+import asyncio
+import collections
+import json
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+from os import environ
+
+from flask import request, make_response, jsonify, Response
+
+import Background
+import Routes
+
+EVENTS_POLL_MIN = float(environ.get('BUNNY_EVENTS_POLL_MIN', 1))         # Seconds between polls while the video keeps changing.
+EVENTS_POLL_MAX = float(environ.get('BUNNY_EVENTS_POLL_MAX', 10))        # Upper bound the interval backs off to while nothing changes.
+EVENTS_POLL_BACKOFF = 1.5                                                # Interval growth per unchanged poll.
+EVENTS_KEEPALIVE = float(environ.get('BUNNY_EVENTS_KEEPALIVE', 15))      # Seconds between SSE comments keeping idle connections open.
+EVENTS_MAX_POLLERS = int(environ.get('BUNNY_EVENTS_MAX_POLLERS', 500))   # Videos polled at once per process.
+EVENTS_QUEUE_SIZE = 16                                                   # Events buffered per subscriber; slow clients skip older ones.
+EVENTS_PATH = environ.get('BUNNY_EVENTS_PATH', os.path.join(tempfile.gettempdir(), "bunny-events.db")) # Empty makes every process poll Bunny itself.
+EVENTS_LEASE = 3 * EVENTS_POLL_MAX                                       # Seconds a process leads the polling of a video without renewing.
+EVENTS_ENVIRON_KEY = "bunny.event_stream"                                # Where `VideoEvents` leaves its stream for the async engine.
+
+TERMINAL_STATUSES = (4, 5, 6) # Finished, error & upload failed.
+EVENT_FIELDS = ("guid", "status", "encodeProgress", "availableResolutions", "length", "transcodingMessages")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS video_polls (
+    library_id TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    latest TEXT,
+    updated_at REAL,
+    PRIMARY KEY (library_id, video_id)
+);
+"""
+
+
+class PollLeases:
+    '''Elects one process per video to poll Bunny, and shares the latest event it saw with the other processes.'''
+
+    def __init__(self, path: str, lease: float) -> None:
+        self.path = path or None
+        self.lease = lease
+        self._connections = Background.SQLiteConnections(self.path, SCHEMA, pragmas = ("synchronous = NORMAL",))
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def lead(self, libraryId: str, videoId: str) -> bool:
+        '''Takes or renews the lease on polling a video, returning whether this process holds it.'''
+        now = time.time()
+        cursor = self._connections.get().execute(
+            """
+            INSERT INTO video_polls (library_id, video_id, owner, lease_expires, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (library_id, video_id) DO UPDATE SET owner = excluded.owner, lease_expires = excluded.lease_expires
+            WHERE video_polls.owner = excluded.owner OR video_polls.lease_expires IS NULL OR video_polls.lease_expires < ?
+            """,
+            (libraryId, videoId, Background.process_token(), now + self.lease, now, now)
+        )
+        return cursor.rowcount > 0
+
+    def share(self, libraryId: str, videoId: str, event: dict) -> None:
+        self._connections.get().execute(
+            "UPDATE video_polls SET latest = ?, updated_at = ? WHERE library_id = ? AND video_id = ?",
+            (json.dumps(event), time.time(), libraryId, videoId)
+        )
+
+    def latest(self, libraryId: str, videoId: str):
+        row = self._connections.get().execute(
+            "SELECT latest FROM video_polls WHERE library_id = ? AND video_id = ?", (libraryId, videoId)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None and row[0] is not None else None
+
+    def resign(self, libraryId: str, videoId: str) -> None:
+        '''Gives up the lease so a process whose clients still listen takes over at once, and forgets videos left alone for a day.'''
+        connection = self._connections.get()
+        connection.execute(
+            "UPDATE video_polls SET owner = NULL, lease_expires = NULL WHERE library_id = ? AND video_id = ? AND owner = ?",
+            (libraryId, videoId, Background.process_token())
+        )
+        connection.execute("DELETE FROM video_polls WHERE owner IS NULL AND updated_at < ?", (time.time() - 86400,))
+
+
+leases = PollLeases(EVENTS_PATH, lease = EVENTS_LEASE)
+
+
+class Subscription:
+    '''
+    The events waiting for one subscriber, dropping the oldest once `maxsize` are waiting.
+    Read with `get` from a worker thread, or with `aget` on an event loop, which binds the subscription to that loop.
+    '''
+    def __init__(self, maxsize: int) -> None:
+        self._events = collections.deque(maxlen = maxsize)
+        self._ready = threading.Condition()
+        self._loop = None
+        self._loop_ready = None
+
+    def put(self, event) -> None:
+        with self._ready:
+            self._events.append(event)
+            self._ready.notify()
+            loop, loop_ready = self._loop, self._loop_ready
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(loop_ready.set)
+            except RuntimeError:
+                pass # The loop has been closed along with its server.
+
+    def get(self, timeout: float):
+        '''The next event, raising `queue.Empty` if none arrives within `timeout` seconds.'''
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._events, timeout):
+                raise queue.Empty
+            return self._events.popleft()
+
+    async def aget(self, timeout: float):
+        '''Event-loop counterpart of `get`, raising `queue.Empty` if no event arrives within `timeout` seconds.'''
+        if self._loop is None:
+            with self._ready:
+                self._loop = asyncio.get_running_loop()
+                self._loop_ready = asyncio.Event()
+        while True:
+            with self._ready:
+                if self._events:
+                    return self._events.popleft()
+                self._loop_ready.clear()
+            try:
+                await asyncio.wait_for(self._loop_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise queue.Empty
+
+
+class VideoPoller:
+    '''
+    Follows one video from a daemon thread while it has subscribers, publishing every change to all of them.
+    The process leading the video through `leases` polls Bunny, with an interval that grows by `EVENTS_POLL_BACKOFF` while
+    the video doesn't change and resets when it does; the others read the leader's latest event every `EVENTS_POLL_MIN`.
+    Subscribers receive `None` once the video reaches a terminal status or can't be polled any more.
+    '''
+    def __init__(self, hub: "VideoEventHub", libraryId: str, videoId: str, api_key: str) -> None:
+        self.hub = hub
+        self.libraryId = libraryId
+        self.videoId = videoId
+        self.api_key = api_key
+        self.latest = None
+        self._subscribers = set()
+        self._wake = threading.Event()
+        self._webhook = False
+        self._thread = threading.Thread(target = self._run, name = f"video-poller-{videoId}", daemon = True)
+
+    def subscribe(self) -> Subscription:
+        '''Called with the hub lock held. New subscribers get the latest known state straight away.'''
+        subscription = Subscription(maxsize = EVENTS_QUEUE_SIZE)
+        if self.latest is not None:
+            subscription.put(self.latest)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.hub.lock:
+            self._subscribers.discard(subscription)
+        self._wake.set() # Lets the thread notice it has no subscribers left without waiting out its interval.
+
+    def wake(self) -> None:
+        '''Polls Bunny right away, even when another process leads the video, e.g. when a webhook announced a change.'''
+        self._webhook = True
+        self._wake.set()
+
+    def publish(self, event) -> None:
+        with self.hub.lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def poll(self):
+        '''Fetches the video once, returning the `status` or `error` event it amounts to.'''
+        bunny_api_response = Routes.make_api_request(
+            url = f"https://video.bunnycdn.com/library/{self.libraryId}/videos/{self.videoId}",
+            method = "GET",
+            headers = {
+                "AccessKey": self.api_key
+            },
+            stream = False
+        )
+        if bunny_api_response.status_code == 401:
+            Routes.invalidate_library_api_key(self.libraryId)
+            self.api_key = Routes.retrieve_library_api_key(self.libraryId)
+            return {"event": "error", "data": {"status": 401}}
+        if bunny_api_response.status_code != 200:
+            return {"event": "error", "data": {"status": bunny_api_response.status_code}}
+
+        video = bunny_api_response.json()
+        return {"event": "status", "data": {field: video.get(field) for field in EVENT_FIELDS}}
+
+    def next_event(self, forced: bool) -> tuple:
+        '''
+        Returns the video's next event and whether it came from Bunny: polled when this process leads the video or is
+        `forced` to, otherwise the leader's latest event (`None` before it has one). Without `leases` every process polls.
+        '''
+        if leases.enabled and not forced:
+            try:
+                if not leases.lead(self.libraryId, self.videoId):
+                    return leases.latest(self.libraryId, self.videoId), False
+            except sqlite3.Error:
+                pass # Polling Bunny directly beats leaving the subscribers without events.
+        try:
+            event = self.poll()
+        except Exception as e:
+            event = {"event": "error", "data": {"error": type(e).__name__}}
+        if leases.enabled:
+            try:
+                leases.share(self.libraryId, self.videoId, event)
+            except sqlite3.Error:
+                pass
+        return event, True
+
+    def _run(self) -> None:
+        interval = EVENTS_POLL_MIN
+        forced = False
+        try:
+            while True:
+                event, polled = self.next_event(forced)
+
+                previous = self.latest
+                changed = event is not None and event != previous
+                if changed:
+                    self.latest = event
+                    self.publish(event)
+                    if self.hub.on_change is not None and polled and previous is not None and event["event"] == "status":
+                        self.hub.on_change(self.libraryId, self.videoId)
+                if polled:
+                    interval = EVENTS_POLL_MIN if changed else min(EVENTS_POLL_MAX, interval * EVENTS_POLL_BACKOFF)
+                else:
+                    interval = EVENTS_POLL_MIN # Reading the leader's event costs Bunny nothing.
+
+                terminal = event is not None and event["event"] == "status" and event["data"]["status"] in TERMINAL_STATUSES
+                gone = event is not None and event["event"] == "error" and event["data"].get("status") == 404
+                if terminal or gone or self.hub.release_if_idle(self):
+                    break
+
+                self._wake.wait(interval)
+                self._wake.clear()
+                forced, self._webhook = self._webhook, False
+                if self.hub.release_if_idle(self):
+                    return
+        finally:
+            if leases.enabled:
+                try:
+                    leases.resign(self.libraryId, self.videoId)
+                except sqlite3.Error:
+                    pass # The lease runs out by itself.
+
+        self.hub.release(self)
+        self.publish(None)
+
+
+class VideoEventHub:
+    '''Hands out subscriptions to the one `VideoPoller` of each video, starting and retiring pollers as needed.'''
+    def __init__(self, max_pollers: int) -> None:
+        self.max_pollers = max_pollers
+        self.on_change = None # Called with (libraryId, videoId) when a poll sees the video change, to drop cached reads.
+        self.lock = threading.Lock()
+        self._pollers = {}
+
+    def subscribe(self, libraryId: str, videoId: str, api_key: str):
+        '''Returns the video's poller and a new subscription queue, or `None` when too many videos are polled already.'''
+        with self.lock:
+            poller = self._pollers.get((libraryId, videoId))
+            started = poller is None
+            if started:
+                if len(self._pollers) >= self.max_pollers:
+                    return None
+                poller = VideoPoller(self, libraryId, videoId, api_key)
+                self._pollers[(libraryId, videoId)] = poller
+            subscription = poller.subscribe()
+        if started:
+            poller._thread.start()
+        return poller, subscription
+
+    def release_if_idle(self, poller: VideoPoller) -> bool:
+        '''Retires the poller when nobody listens any more; decided under the lock so no subscriber is left behind.'''
+        with self.lock:
+            if poller._subscribers:
+                return False
+            if self._pollers.get((poller.libraryId, poller.videoId)) is poller:
+                del self._pollers[(poller.libraryId, poller.videoId)]
+            return True
+
+    def release(self, poller: VideoPoller) -> None:
+        with self.lock:
+            if self._pollers.get((poller.libraryId, poller.videoId)) is poller:
+                del self._pollers[(poller.libraryId, poller.videoId)]
+
+    def wake(self, libraryId: str, videoId: str) -> None:
+        poller = self._pollers.get((libraryId, videoId))
+        if poller is not None:
+            poller.wake()
+
+    def stats(self) -> dict:
+        with self.lock:
+            pollers = list(self._pollers.values())
+        return {
+            "pollers": len(pollers),
+            "subscribers": sum(len(poller._subscribers) for poller in pollers),
+            "max_pollers": self.max_pollers
+        }
+
+
+hub = VideoEventHub(max_pollers = EVENTS_MAX_POLLERS)
+
+
+class EventStream:
+    '''
+    The SSE body of one subscriber. Iterating it waits for events on the calling worker thread; the async engine
+    iterates it with `async for` instead, so waiting subscribers don't hold a thread. Closing it unsubscribes.
+    '''
+    def __init__(self, poller: VideoPoller, subscription: Subscription) -> None:
+        self.poller = poller
+        self.subscription = subscription
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            yield self.format_retry()
+            while True:
+                try:
+                    event = self.subscription.get(timeout = EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield self.format(event)
+        finally:
+            self.close()
+
+    async def __aiter__(self):
+        try:
+            yield self.format_retry()
+            while True:
+                try:
+                    event = await self.subscription.aget(timeout = EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield b": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield self.format(event)
+        finally:
+            self.close()
+
+    @staticmethod
+    def format_retry() -> bytes:
+        return f"retry: {int(EVENTS_POLL_MIN * 1000)}\n\n".encode()
+
+    @staticmethod
+    def format(event: dict) -> bytes:
+        return f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n".encode()
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self.poller.unsubscribe(self.subscription)
+
+
+@Routes.require_library_api_key
+def VideoEvents(libraryId, videoId, _library_api_key):
+    '''
+    Streams a video's encode progress as Server-Sent Events: `status` events whenever it changes and `error` events
+    when Bunny can't be polled. The stream ends once the video reaches a terminal status.
+    '''
+    subscribed = hub.subscribe(libraryId, videoId, _library_api_key)
+    if subscribed is None:
+        api_response = make_response(jsonify(request.metadata['responses'][503]), 503)
+        api_response.headers["Retry-After"] = str(int(EVENTS_POLL_MAX))
+        return api_response
+    stream = EventStream(*subscribed)
+    request.environ[EVENTS_ENVIRON_KEY] = stream
+
+    api_response = Response(stream, mimetype = "text/event-stream")
+    api_response.headers["Cache-Control"] = "no-cache"
+    api_response.headers["X-Accel-Buffering"] = "no" # Keeps reverse proxies from holding events back.
+    return api_response
@@ -0,0 +1,73 @@
+"""
+Background health probing of Bunny's upstream hosts, so `/status` never waits on Bunny.
+"""
+import time
+from os import environ
+
+import requests
+
+import Background
+import Routes
+import Sessions
+
+PROBE_INTERVAL = float(environ.get('BUNNY_PROBE_INTERVAL', 15))        # Seconds between probes of each upstream host.
+PROBE_TIMEOUT = float(environ.get('BUNNY_PROBE_TIMEOUT', 5))           # Seconds before a probe counts as failed.
+PROBE_STALE_AFTER = float(environ.get('BUNNY_PROBE_STALE_AFTER', 60))  # Results older than this are reported as stale.
+
+PROBE_URLS = {
+    "api.bunny.net": "https://api.bunny.net",
+    "video.bunnycdn.com": "https://video.bunnycdn.com"
+}
+
+
+class UpstreamProber:
+    '''Probes each upstream host on an interval from a daemon thread and keeps the latest result per host.'''
+
+    def __init__(self, urls: dict, interval: float, timeout: float, stale_after: float) -> None:
+        self.urls = urls
+        self.interval = interval
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.results = {}
+        self._thread = Background.ProcessThread(self._run, name = "upstream-prober")
+
+    def ensure_running(self) -> None:
+        self._thread.ensure_running()
+
+    def probe(self, url: str) -> dict:
+        started = time.monotonic()
+        result = {"status": None, "error": None}
+        try:
+            response = Sessions.get_session(url).get(
+                url,
+                headers = {"AccessKey": Routes.ACCOUNT_API_KEY, "accept": "application/json"},
+                timeout = self.timeout
+            )
+            result["status"] = response.status_code
+        except requests.RequestException as e:
+            result["error"] = type(e).__name__
+        result["latency_ms"] = round((time.monotonic() - started) * 1000, 1)
+        result["checked_at"] = time.time()
+        return result
+
+    def _run(self) -> None:
+        while True:
+            for host, url in self.urls.items():
+                self.results[host] = self.probe(url)
+            time.sleep(self.interval)
+
+    def snapshot(self) -> dict:
+        '''Returns the latest result per host with its age in seconds; hosts not probed yet report `None`.'''
+        now = time.time()
+        snapshot = {}
+        for host in self.urls:
+            result = self.results.get(host)
+            if result is None:
+                snapshot[host] = None
+                continue
+            age = now - result["checked_at"]
+            snapshot[host] = dict(result, age = round(age, 1), stale = age > self.stale_after)
+        return snapshot
+
+
+prober = UpstreamProber(PROBE_URLS, interval = PROBE_INTERVAL, timeout = PROBE_TIMEOUT, stale_after = PROBE_STALE_AFTER)
@@ -0,0 +1,115 @@
+"""
+Cache invalidation shared by the worker processes of a host.
+
+Every worker caches responses in its own memory, so a webhook or mutation handled by one worker must reach the others.
+Invalidations are appended to a small SQLite journal at `BUNNY_INVALIDATION_PATH`, which every process polls from a
+daemon thread and replays into its own caches. Workers on other hosts don't share the journal, so deployments spread
+over several hosts should keep `BUNNY_VIDEO_CACHE_TTL` short.
+"""
+import os
+import sqlite3
+import tempfile
+import time
+from os import environ
+
+import Background
+
+INVALIDATION_PATH = environ.get('BUNNY_INVALIDATION_PATH', os.path.join(tempfile.gettempdir(), "bunny-invalidations.db")) # Empty disables the journal.
+INVALIDATION_POLL_INTERVAL = float(environ.get('BUNNY_INVALIDATION_POLL_INTERVAL', 1))  # Seconds before other workers drop what one invalidated.
+INVALIDATION_RETENTION = 3600  # Seconds journal entries are kept; processes only ever replay entries newer than their start.
+INVALIDATION_PRUNE_EVERY = 60  # Polls between deletions of expired entries.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invalidations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    library_id TEXT NOT NULL,
+    video_id TEXT,
+    origin TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS invalidations_created ON invalidations (created_at);
+"""
+
+
+class InvalidationJournal:
+    '''Publishes this process's invalidations and replays the ones published by other processes through `on_invalidate`.'''
+
+    def __init__(self, path: str, poll_interval: float) -> None:
+        self.path = path or None
+        self.poll_interval = poll_interval
+        self.on_invalidate = None # Called with (libraryId, videoId) for every invalidation made by another process.
+        self.published = 0
+        self.replayed = 0
+        self.errors = 0
+        self._connections = Background.SQLiteConnections(self.path, SCHEMA, pragmas = ("synchronous = NORMAL",))
+        self._thread = Background.ProcessThread(self._run, name = "invalidation-journal", on_start = self._on_start)
+        self._last_id = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    @property
+    def origin(self) -> str:
+        '''Tags this process's entries so it doesn't replay them.'''
+        return Background.process_token()
+
+    def ensure_running(self) -> None:
+        if self.enabled:
+            self._thread.ensure_running()
+
+    def _on_start(self) -> None:
+        # A process starting its poller has nothing cached from before, so older entries needn't be replayed.
+        try:
+            self._last_id = self._connections.get().execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+        except sqlite3.Error:
+            self.errors += 1 # Replaying from the start only drops a few more cache entries.
+
+    def publish(self, libraryId: str, videoId: str = None) -> None:
+        if not self.enabled:
+            return
+        self.ensure_running()
+        try:
+            self._connections.get().execute(
+                "INSERT INTO invalidations (library_id, video_id, origin, created_at) VALUES (?, ?, ?, ?)",
+                (libraryId, videoId, self.origin, time.time())
+            )
+            self.published += 1
+        except sqlite3.Error:
+            self.errors += 1 # The other workers' entries expire with their cache TTL instead.
+
+    def poll(self) -> None:
+        connection = self._connections.get()
+        rows = connection.execute(
+            "SELECT id, library_id, video_id, origin FROM invalidations WHERE id > ? ORDER BY id", (self._last_id,)
+        ).fetchall()
+        for entry_id, libraryId, videoId, origin in rows:
+            if origin != self.origin and self.on_invalidate is not None:
+                self.on_invalidate(libraryId, videoId)
+                self.replayed += 1
+            self._last_id = entry_id
+
+    def _run(self) -> None:
+        polls = 0
+        while True:
+            try:
+                self.poll()
+                polls += 1
+                if polls % INVALIDATION_PRUNE_EVERY == 0:
+                    self._connections.get().execute(
+                        "DELETE FROM invalidations WHERE created_at < ?", (time.time() - INVALIDATION_RETENTION,)
+                    )
+            except sqlite3.Error:
+                self.errors += 1
+            time.sleep(self.poll_interval)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "published": self.published,
+            "replayed": self.replayed,
+            "errors": self.errors
+        }
+
+
+journal = InvalidationJournal(INVALIDATION_PATH, poll_interval = INVALIDATION_POLL_INTERVAL)
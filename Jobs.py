@@ -0,0 +1,450 @@
+"""
+Persistent bulk jobs (reencode or repackage every video of a selection), worked through in the background.
+
+Jobs are stored in SQLite at `BUNNY_JOBS_PATH`; leaving it unset disables the job routes. Each process runs a job
+runner that claims one job at a time through a lease it keeps renewing, so a job left behind by a crashed or
+restarted process is picked up again once its lease expires, resuming from the videos it hadn't finished.
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os import environ
+from urllib.parse import urlencode
+
+import requests
+from flask import request, make_response, jsonify
+
+import Background
+import Routes
+import Throttling
+
+JOBS_PATH = environ.get('BUNNY_JOBS_PATH')                              # Unset disables the job subsystem.
+JOB_CONCURRENCY = int(environ.get('BUNNY_JOB_CONCURRENCY', 4))          # Upstream calls in flight per job.
+JOB_RATE = float(environ.get('BUNNY_JOB_RATE', 10))                     # Calls per second for all jobs of a process, leaving room for live traffic.
+JOB_MAX_ATTEMPTS = int(environ.get('BUNNY_JOB_MAX_ATTEMPTS', 3))        # Attempts per video before it is marked failed.
+JOB_LEASE = float(environ.get('BUNNY_JOB_LEASE', 60))                   # Seconds a job stays claimed without a heartbeat.
+JOB_MAX_WAIT = float(environ.get('BUNNY_JOB_MAX_WAIT', 300))            # Seconds a video may wait out rate limits and open circuits before it fails.
+JOB_POLL_INTERVAL = float(environ.get('BUNNY_JOB_POLL_INTERVAL', 5))    # Seconds between looks for claimable jobs.
+JOB_MAX_IDS = int(environ.get('BUNNY_JOB_MAX_IDS', 100000))
+JOB_THROUGHPUT_WINDOW = 60                                              # Seconds over which the recent throughput is measured.
+
+JOB_ACTIONS = {
+    "reencode": "reencode",
+    "repackage": "repackage"
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    library_id TEXT NOT NULL,
+    action TEXT NOT NULL,
+    options TEXT NOT NULL,
+    filter TEXT,
+    state TEXT NOT NULL,
+    expanded INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_status INTEGER,
+    last_error TEXT,
+    updated_at REAL,
+    PRIMARY KEY (job_id, video_id)
+);
+CREATE INDEX IF NOT EXISTS job_items_state ON job_items (job_id, state);
+CREATE INDEX IF NOT EXISTS job_items_updated ON job_items (job_id, updated_at);
+"""
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    '''A job that can never complete, such as one on a library that doesn't exist; retrying it would only repeat the error.'''
+    pass
+
+
+def add_error_column(connection: sqlite3.Connection) -> None:
+    '''Adds `jobs.error` to databases created before jobs could fail as a whole.'''
+    if not any(column[1] == "error" for column in connection.execute("PRAGMA table_info(jobs)")):
+        try:
+            connection.execute("ALTER TABLE jobs ADD COLUMN error TEXT")
+        except sqlite3.OperationalError:
+            pass # Added by another process meanwhile.
+
+
+class JobRunner:
+    '''Claims jobs from the database one at a time and works through their videos with a bounded thread pool.'''
+
+    def __init__(self, path: str, concurrency: int, rate: float, lease: float, poll_interval: float) -> None:
+        self.path = path
+        self.concurrency = concurrency
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.rate_limit = Throttling.TokenBucket(rate = rate)
+        self.on_change = None # Called with (libraryId, videoId) for every video a job changed, to drop cached reads.
+        self._connections = Background.SQLiteConnections(path, SCHEMA, on_connect = add_error_column)
+        self._thread = Background.ProcessThread(self._run, name = "job-runner")
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    @property
+    def owner(self) -> str:
+        return Background.process_token()
+
+    def _connection(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def ensure_running(self) -> None:
+        if self.enabled:
+            self._thread.ensure_running()
+
+    def submit(self, libraryId: str, action: str, options: dict, video_ids: list = None, video_filter: dict = None) -> str:
+        '''Stores a new job; videos are either given up front or found by the runner from `video_filter`.'''
+        jobId = str(uuid.uuid4())
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT INTO jobs (id, library_id, action, options, filter, state, expanded, created_at) VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)",
+                (jobId, libraryId, action, json.dumps(options), json.dumps(video_filter) if video_ids is None else None, int(video_ids is not None), now)
+            )
+            if video_ids is not None:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO job_items (job_id, video_id, state, updated_at) VALUES (?, ?, 'pending', ?)",
+                    [(jobId, videoId, now) for videoId in video_ids]
+                )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return jobId
+
+    def cancel(self, jobId: str) -> bool:
+        cursor = self._connection().execute(
+            "UPDATE jobs SET state = 'cancelled', finished_at = ? WHERE id = ? AND state IN ('pending', 'running')", (time.time(), jobId)
+        )
+        return cursor.rowcount > 0
+
+    def claim(self):
+        '''Takes the oldest unfinished job whose lease is free or expired, returning its row as a dict or `None`.'''
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.row_factory = sqlite3.Row
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE state IN ('pending', 'running') AND (lease_expires IS NULL OR lease_expires < ?) ORDER BY created_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            connection.row_factory = None
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            connection.execute(
+                "UPDATE jobs SET state = 'running', started_at = COALESCE(started_at, ?), lease_owner = ?, lease_expires = ? WHERE id = ?",
+                (now, self.owner, now + self.lease, row["id"])
+            )
+            # Videos the previous owner was working on when it died are done again.
+            connection.execute("UPDATE job_items SET state = 'pending' WHERE job_id = ? AND state = 'running'", (row["id"],))
+        except BaseException:
+            connection.row_factory = None
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return dict(row)
+
+    def heartbeat(self, jobId: str) -> None:
+        '''Renews the lease on a job, raising `JobCancelled` if it was cancelled or taken over meanwhile.'''
+        cursor = self._connection().execute(
+            "UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND state = 'running'",
+            (time.time() + self.lease, jobId, self.owner)
+        )
+        if cursor.rowcount == 0:
+            raise JobCancelled(jobId)
+
+    def fail(self, jobId: str, error: str) -> None:
+        '''Ends a job this process holds the lease on as failed, so it isn't claimed again.'''
+        self._connection().execute(
+            "UPDATE jobs SET state = 'failed', error = ?, finished_at = ?, lease_owner = NULL, lease_expires = NULL WHERE id = ? AND state = 'running' AND lease_owner = ?",
+            (error, time.time(), jobId, self.owner)
+        )
+
+    @contextmanager
+    def owned(self, jobId: str):
+        '''A write transaction on a job whose lease this process still holds, raising `JobCancelled` otherwise.'''
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if connection.execute(
+                "SELECT 1 FROM jobs WHERE id = ? AND lease_owner = ? AND state = 'running'", (jobId, self.owner)
+            ).fetchone() is None:
+                raise JobCancelled(jobId)
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def keep_leased(self, jobId: str, lost: threading.Event, done: threading.Event) -> None:
+        '''Renews the lease on a job every third of its length until `done`, setting `lost` if it was cancelled or taken over.'''
+        while not done.wait(self.lease / 3):
+            try:
+                self.heartbeat(jobId)
+            except JobCancelled:
+                lost.set()
+                return
+            except sqlite3.Error:
+                continue # Tried again on the next tick; the owned writes notice if the lease lapsed meanwhile.
+
+    def _run(self) -> None:
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.Error:
+                job = None
+            if job is None:
+                time.sleep(self.poll_interval)
+                continue
+            try:
+                self.run_job(job)
+            except JobCancelled:
+                pass
+            except JobFailed as e:
+                try:
+                    self.fail(job["id"], str(e))
+                except sqlite3.Error:
+                    pass # Claimed again once the lease expires, and failed again then.
+            except Exception:
+                # Transient failures (Bunny unreachable, 5xx, ...): the job keeps its lease until it expires, then this
+                # or another process resumes it.
+                time.sleep(self.poll_interval)
+
+    def run_job(self, job: dict) -> None:
+        lost = threading.Event()
+        done = threading.Event()
+        threading.Thread(target = self.keep_leased, args = (job["id"], lost, done), name = "job-lease", daemon = True).start()
+        try:
+            self.work(job, lost)
+        finally:
+            done.set()
+
+    def work(self, job: dict, lost: threading.Event) -> None:
+        api_key = Routes.retrieve_library_api_key(job["library_id"])
+        if api_key is None:
+            raise JobFailed("The requested library does not exist")
+        if not job["expanded"]:
+            self.expand(job, api_key)
+
+        connection = self._connection()
+        with ThreadPoolExecutor(max_workers = self.concurrency) as executor:
+            while True:
+                if lost.is_set():
+                    raise JobCancelled(job["id"])
+                with self.owned(job["id"]) as connection:
+                    video_ids = [row[0] for row in connection.execute(
+                        "SELECT video_id FROM job_items WHERE job_id = ? AND state = 'pending' LIMIT ?", (job["id"], self.concurrency * 4)
+                    )]
+                    connection.executemany(
+                        "UPDATE job_items SET state = 'running' WHERE job_id = ? AND video_id = ?", [(job["id"], videoId) for videoId in video_ids]
+                    )
+                if not video_ids:
+                    break
+
+                results = list(executor.map(lambda videoId: self.process(job, videoId, api_key, lost), video_ids))
+                now = time.time()
+                with self.owned(job["id"]) as connection:
+                    connection.executemany(
+                        "UPDATE job_items SET state = ?, attempts = attempts + ?, last_status = ?, last_error = ?, updated_at = ? WHERE job_id = ? AND video_id = ?",
+                        [(state, attempts, status, error, now, job["id"], videoId) for videoId, (state, attempts, status, error) in zip(video_ids, results)]
+                    )
+                if self.on_change is not None:
+                    for videoId, (state, _, _, _) in zip(video_ids, results):
+                        if state == "done":
+                            self.on_change(job["library_id"], videoId)
+                if any(status == 401 for _, _, status, _ in results):
+                    Routes.invalidate_library_api_key(job["library_id"])
+                    api_key = Routes.retrieve_library_api_key(job["library_id"])
+
+        connection.execute(
+            "UPDATE jobs SET state = 'done', finished_at = ?, lease_owner = NULL, lease_expires = NULL WHERE id = ? AND state = 'running' AND lease_owner = ?",
+            (time.time(), job["id"], self.owner)
+        )
+
+    def expand(self, job: dict, api_key: str) -> None:
+        '''
+        Pages through `ListVideos` to add every video matching the job's filter, then marks the job expanded.
+        A 4xx answer fails the job with `JobFailed`; other failures are raised to be retried once the lease expires.
+        '''
+        video_filter = json.loads(job["filter"] or "{}")
+        statuses = video_filter.get("status")
+        query = {key: video_filter[key] for key in ("search", "collection") if video_filter.get(key)}
+        page = 1
+        while True:
+            self.heartbeat(job["id"])
+            bunny_api_response = Routes.make_api_request(
+                url = f"https://video.bunnycdn.com/library/{job['library_id']}/videos?" + urlencode(dict(query, page = page, itemsPerPage = Routes.PAGINATION_PAGE_SIZE)),
+                method = "GET",
+                headers = {
+                    "AccessKey": api_key
+                },
+                stream = False
+            )
+            if bunny_api_response.status_code == 401:
+                Routes.invalidate_library_api_key(job["library_id"])
+            if 400 <= bunny_api_response.status_code < 500:
+                raise JobFailed(f"ListVideos answered {bunny_api_response.status_code}")
+            if bunny_api_response.status_code != 200:
+                raise requests.HTTPError(f"ListVideos answered {bunny_api_response.status_code}", response = bunny_api_response)
+            body = bunny_api_response.json()
+            items = body.get("items") or []
+            with self.owned(job["id"]) as connection:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO job_items (job_id, video_id, state, updated_at) VALUES (?, ?, 'pending', ?)",
+                    [(job["id"], video["guid"], time.time()) for video in items if statuses is None or video.get("status") in statuses]
+                )
+            if len(items) == 0 or page * Routes.PAGINATION_PAGE_SIZE >= body.get("totalItems", 0):
+                break
+            page += 1
+        with self.owned(job["id"]) as connection:
+            connection.execute("UPDATE jobs SET expanded = 1 WHERE id = ?", (job["id"],))
+
+    def process(self, job: dict, videoId: str, api_key: str, lost: threading.Event) -> tuple:
+        '''
+        Calls the job's action for one video through `Routes.retry_upstream_call`, returning (state, attempts, last status,
+        last error). Waits end early once the job's lease is `lost`.
+        '''
+        options = json.loads(job["options"])
+        url = f"https://video.bunnycdn.com/library/{job['library_id']}/videos/{videoId}/{JOB_ACTIONS[job['action']]}"
+        if options:
+            url += "?" + urlencode({key: str(value).lower() if isinstance(value, bool) else value for key, value in options.items()})
+
+        def send():
+            self.rate_limit.acquire()
+            return Routes.make_api_request(
+                url = url,
+                method = "POST",
+                headers = {
+                    "AccessKey": api_key
+                },
+                stream = False
+            )
+
+        status, attempts, error = Routes.retry_upstream_call(send, attempts = JOB_MAX_ATTEMPTS, max_wait = JOB_MAX_WAIT, stop = lost)
+        return ("done" if status is not None and status < 400 else "failed"), attempts, status, error
+
+    def status(self, jobId: str):
+        '''Progress of a job, or `None` if it doesn't exist.'''
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT library_id, action, options, state, expanded, created_at, started_at, finished_at, error FROM jobs WHERE id = ?", (jobId,)
+        ).fetchone()
+        if row is None:
+            return None
+        libraryId, action, options, state, expanded, created_at, started_at, finished_at, error = row
+
+        counts = dict(connection.execute("SELECT state, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY state", (jobId,)).fetchall())
+        recent = connection.execute(
+            "SELECT COUNT(*) FROM job_items WHERE job_id = ? AND state IN ('done', 'failed') AND updated_at >= ?",
+            (jobId, time.time() - JOB_THROUGHPUT_WINDOW)
+        ).fetchone()[0]
+        failures = [
+            {"videoId": videoId, "status": status, "error": error, "attempts": attempts}
+            for videoId, status, error, attempts in connection.execute(
+                "SELECT video_id, last_status, last_error, attempts FROM job_items WHERE job_id = ? AND state = 'failed' ORDER BY updated_at LIMIT 100",
+                (jobId,)
+            )
+        ]
+
+        finished = counts.get("done", 0) + counts.get("failed", 0)
+        elapsed = (finished_at or time.time()) - started_at if started_at is not None else 0
+        return {
+            "id": jobId,
+            "libraryId": libraryId,
+            "action": action,
+            "options": json.loads(options),
+            "state": state if expanded or state != "running" else "expanding",
+            "error": error, # Why a "failed" job stopped.
+            "total": sum(counts.values()),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "remaining": counts.get("pending", 0) + counts.get("running", 0),
+            "createdAt": created_at,
+            "startedAt": started_at,
+            "finishedAt": finished_at,
+            "throughput": round(finished / elapsed, 2) if elapsed > 0 else 0.0,       # Videos per second since the job started.
+            "recentThroughput": round(recent / JOB_THROUGHPUT_WINDOW, 2),           # Videos per second over the last minute.
+            "failures": failures
+        }
+
+
+runner = JobRunner(JOBS_PATH, concurrency = JOB_CONCURRENCY, rate = JOB_RATE, lease = JOB_LEASE, poll_interval = JOB_POLL_INTERVAL)
+
+
+def CreateJob(libraryId):
+    '''
+    Starts a bulk job from `{"action": "reencode" | "repackage", "ids": [...]}` or, instead of "ids",
+    `{"filter": {"search", "collection", "status": [...]}}`. Repackage options such as keepOriginalFiles go in "options".
+    '''
+    if not runner.enabled:
+        return make_response(jsonify(request.metadata['responses'][404]), 404)
+
+    payload = request.get_json(silent = True) or {}
+    action = payload.get("action")
+    video_ids = payload.get("ids")
+    video_filter = payload.get("filter")
+    options = payload.get("options") or {}
+    if action not in JOB_ACTIONS:
+        return make_response(jsonify(f"action must be one of {', '.join(JOB_ACTIONS)}"), 400)
+    if (video_ids is None) == (video_filter is None):
+        return make_response(jsonify("Give either \"ids\" or \"filter\""), 400)
+    if video_ids is not None:
+        if not isinstance(video_ids, list) or len(video_ids) == 0:
+            return make_response(jsonify("ids must be a non-empty list of video IDs"), 400)
+        video_ids = list(dict.fromkeys(str(videoId).strip() for videoId in video_ids if str(videoId).strip()))
+        if len(video_ids) > JOB_MAX_IDS:
+            return make_response(jsonify(f"At most {JOB_MAX_IDS} video IDs can be given per job"), 400)
+    if video_filter is not None and not isinstance(video_filter, dict):
+        return make_response(jsonify("filter must be an object"), 400)
+    if not isinstance(options, dict):
+        return make_response(jsonify("options must be an object"), 400)
+
+    runner.ensure_running()
+    jobId = runner.submit(libraryId, action, options, video_ids = video_ids, video_filter = video_filter)
+    api_response = make_response(jsonify(runner.status(jobId)), 202)
+    api_response.headers["Location"] = f"/jobs/{jobId}"
+    return api_response
+
+
+def GetJob(jobId):
+    if not runner.enabled:
+        return make_response(jsonify(request.metadata['responses'][404]), 404)
+    status = runner.status(jobId)
+    if status is None:
+        return make_response(jsonify("The requested job does not exist"), 404)
+    return jsonify(status)
+
+
+def CancelJob(jobId):
+    if not runner.enabled:
+        return make_response(jsonify(request.metadata['responses'][404]), 404)
+    if runner.status(jobId) is None:
+        return make_response(jsonify("The requested job does not exist"), 404)
+    runner.cancel(jobId)
+    return jsonify(runner.status(jobId))
@@ -0,0 +1,259 @@
+"""
+Timeout, retry, hedging and circuit breaking policy for upstream calls, configured per route through the "upstream" metadata entry.
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os import environ
+from urllib.parse import urlsplit
+
+import requests
+
+CONNECT_TIMEOUT = float(environ.get('BUNNY_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(environ.get('BUNNY_READ_TIMEOUT', 30))
+RETRIES = int(environ.get('BUNNY_RETRIES', 2))                  # Extra attempts for idempotent calls.
+RETRY_BACKOFF = float(environ.get('BUNNY_RETRY_BACKOFF', 0.2))  # Base of the exponential backoff, in seconds.
+RETRY_MAX_BACKOFF = float(environ.get('BUNNY_RETRY_MAX_BACKOFF', 5))
+HEDGE_WORKERS = int(environ.get('BUNNY_HEDGE_WORKERS', 64))     # Threads shared by hedged calls in the sync engine.
+HEDGE_MIN_SAMPLES = 20                                          # Latencies needed before a route's p95 is trusted.
+
+BREAKER_WINDOW = int(environ.get('BUNNY_BREAKER_WINDOW', 50))               # Recent calls a breaker judges the upstream on.
+BREAKER_MIN_CALLS = int(environ.get('BUNNY_BREAKER_MIN_CALLS', 10))         # Calls needed in the window before a breaker may open.
+BREAKER_ERROR_RATE = float(environ.get('BUNNY_BREAKER_ERROR_RATE', 0.5))    # Share of failed calls that opens a breaker.
+BREAKER_SLOW_CALL = float(environ.get('BUNNY_BREAKER_SLOW_CALL', 10))       # Seconds after which a call counts as slow.
+BREAKER_SLOW_RATE = float(environ.get('BUNNY_BREAKER_SLOW_RATE', 0.8))      # Share of slow calls that opens a breaker.
+BREAKER_OPEN_FOR = float(environ.get('BUNNY_BREAKER_OPEN_FOR', 30))         # Seconds an open breaker fails fast before probing.
+BREAKER_HALF_OPEN_CALLS = int(environ.get('BUNNY_BREAKER_HALF_OPEN_CALLS', 1)) # Probe calls let through at once while half-open.
+
+RETRYABLE_STATUS_CODES = (502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "DELETE") # PUT is left out: its body may be a stream that can't be sent twice.
+
+
+class LatencyTracker:
+    '''Keeps the most recent upstream latencies per route to estimate their p95.'''
+    def __init__(self, samples: int = 200) -> None:
+        self.samples = samples
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(name, deque(maxlen = self.samples)).append(seconds)
+
+    def p95(self, name: str):
+        '''The route's 95th percentile latency in seconds, or `None` until enough calls have been seen.'''
+        latencies = self._latencies.get(name)
+        if latencies is None or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+
+latencies = LatencyTracker()
+
+
+class CircuitOpen(requests.RequestException):
+    '''Raised instead of calling an upstream whose circuit breaker is open.'''
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__(f"Circuit for {name} is open, retry after {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    '''
+    Stops calling an upstream once too many of its recent calls failed (errors or 5xx) or were slow.
+    An open breaker fails fast with `CircuitOpen` for `open_for` seconds, then goes half-open and lets
+    `half_open_calls` probes through at a time: a healthy probe closes it, a failed one opens it again.
+    '''
+    def __init__(self, name: str, window: int = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS,
+                 error_rate: float = BREAKER_ERROR_RATE, slow_call: float = BREAKER_SLOW_CALL, slow_rate: float = BREAKER_SLOW_RATE,
+                 open_for: float = BREAKER_OPEN_FOR, half_open_calls: int = BREAKER_HALF_OPEN_CALLS) -> None:
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_for = open_for
+        self.half_open_calls = half_open_calls
+        self.state = "closed"
+        self.opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen = window) # (failed, slow) per recent call.
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        '''Raises `CircuitOpen` when the call must not be sent; otherwise the caller must report it with `after_call`.'''
+        with self._lock:
+            if self.state == "open":
+                remaining = self._opened_at + self.open_for - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, remaining)
+                self.state = "half_open"
+                self._probes = 0
+            if self.state == "half_open":
+                if self._probes >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpen(self.name, self.open_for)
+                self._probes += 1
+
+    def after_call(self, failed: bool, seconds: float) -> None:
+        slow = seconds >= self.slow_call
+        with self._lock:
+            if self.state == "half_open":
+                self._probes = max(0, self._probes - 1)
+                if failed or slow:
+                    self._open()
+                else:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                return
+            if self.state == "open":
+                return
+
+            self._outcomes.append((failed, slow))
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            if (sum(failed for failed, _ in self._outcomes) / calls >= self.error_rate
+                    or sum(slow for _, slow in self._outcomes) / calls >= self.slow_rate):
+                self._open()
+
+    def abandon_call(self) -> None:
+        '''Forgets a call let through by `before_call` whose outcome will never be known, such as a cancelled hedge.'''
+        with self._lock:
+            if self.state == "half_open":
+                self._probes = max(0, self._probes - 1)
+
+    def _open(self) -> None:
+        self.state = "open"
+        self.opened += 1
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    def snapshot(self) -> dict:
+        calls = len(self._outcomes)
+        snapshot = {
+            "state": self.state,
+            "calls": calls,
+            "error_rate": round(sum(failed for failed, _ in self._outcomes) / calls, 3) if calls else 0.0,
+            "slow_rate": round(sum(slow for _, slow in self._outcomes) / calls, 3) if calls else 0.0,
+            "opened": self.opened,
+            "rejected": self.rejected
+        }
+        if self.state == "open":
+            snapshot["retry_after"] = round(max(0.0, self._opened_at + self.open_for - time.monotonic()), 1)
+        return snapshot
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str, config: dict = None) -> CircuitBreaker:
+    '''Returns the breaker called `name`, created with `config` the first time it is asked for.'''
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name, **(config or {})))
+    return breaker
+
+
+def breaker_stats() -> dict:
+    return {name: breaker.snapshot() for name, breaker in list(_breakers.items())}
+
+
+def is_failure(response) -> bool:
+    '''
+    Outcomes that count against a breaker: transport errors and 5xx answers.
+    429s are the scheduler's business, and other exceptions (such as a client aborting its upload) aren't Bunny's fault.
+    '''
+    if isinstance(response, Exception):
+        return isinstance(response, (requests.ConnectionError, requests.Timeout))
+    return response.status_code >= 500
+
+
+class UpstreamPolicy:
+    '''How one upstream call is timed out, retried and hedged.'''
+    def __init__(self, name: str = None, connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 retries: int = RETRIES, backoff: float = RETRY_BACKOFF, max_backoff: float = RETRY_MAX_BACKOFF,
+                 hedge: bool = False, hedge_after: float = None, circuit: dict = None) -> None:
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.circuit = circuit or {}
+
+    @classmethod
+    def from_metadata(cls, metadata: dict, name: str = None) -> "UpstreamPolicy":
+        '''Builds the policy of a route from its "upstream" metadata, falling back to the environment defaults.'''
+        return cls(name = name, **((metadata or {}).get("upstream") or {}))
+
+    @property
+    def timeout(self) -> tuple:
+        return (self.connect_timeout, self.read_timeout)
+
+    def attempts(self, method: str) -> int:
+        '''Total attempts for a call: retries only ever apply to idempotent methods.'''
+        return 1 + (self.retries if method in IDEMPOTENT_METHODS else 0)
+
+    def backoff_delay(self, attempt: int) -> float:
+        '''Exponential backoff with full jitter before retry number `attempt + 1`.'''
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def hedge_delay(self, method: str):
+        '''Seconds after which a duplicate GET is sent, or `None` when this call isn't hedged.'''
+        if not self.hedge or method != "GET":
+            return None
+        if self.hedge_after is not None:
+            return self.hedge_after
+        return latencies.p95(self.name)
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        '''
+        The circuit breaker guarding a call to `url`: one per upstream host, or one per host and route when the
+        route's "circuit" settings ask for `per_route`. The remaining settings override the breaker defaults, which is
+        only allowed together with `per_route`: a host's breaker is shared by all its routes.
+        '''
+        config = dict(self.circuit)
+        name = urlsplit(url).netloc
+        if config.pop("per_route", False) and self.name is not None:
+            name = f"{name} {self.name}"
+        return get_breaker(name, config)
+
+
+default_policy = UpstreamPolicy()
+
+_hedge_executor = ThreadPoolExecutor(max_workers = HEDGE_WORKERS, thread_name_prefix = "hedge")
+
+
+def hedged(send, delay: float):
+    '''
+    Calls `send()` and, if it hasn't answered within `delay` seconds, calls it again; the first reply wins.
+    A failed attempt only wins when the other one fails too.
+    '''
+    primary = _hedge_executor.submit(send)
+    done, _ = wait([primary], timeout = delay)
+    if done:
+        return primary.result()
+
+    secondary = _hedge_executor.submit(send)
+    done, pending = wait([primary, secondary], return_when = FIRST_COMPLETED)
+    # Both attempts may finish within the same wait, in which case one that didn't fail is preferred.
+    finished = sorted(done, key = lambda future: future.exception() is not None)
+    winner, losers = finished[0], set(finished[1:]) | pending
+    if winner.exception() is not None and pending:
+        winner, losers = pending.pop(), set()
+
+    for loser in losers:
+        loser.add_done_callback(lambda future: future.exception() is None and future.result().close())
+    return winner.result()
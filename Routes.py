@@ -2,70 +2,256 @@
 File containing all of our API route endpoints.
 """
 import requests
-from flask import request, make_response, jsonify
+from flask import request, make_response, jsonify, Response, has_request_context, g
+from werkzeug.exceptions import ClientDisconnected
 from os import environ
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode, urlsplit
+from array import array
 
+import bisect
+import contextvars
 import datetime
 import hashlib
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+
+import Caching
+import Resilience
+import Sessions
+import Throttling
 
 load_dotenv(".env")
 ACCOUNT_API_KEY = environ.get('BUNNY_ACCOUNT_KEY')
 if ACCOUNT_API_KEY is None:
     raise ValueError("No BUNNY_ACCOUNT_KEY environment variable was set!")
 
-method_map = {
-    "GET": requests.get,
-    "HEAD": requests.head,
-    "OPTIONS": requests.options,
-    "PUT": requests.put,
-    "DELETE": requests.delete,
-    "POST": requests.post,
-    "PATCH": requests.patch
+allowed_methods = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "POST", "PATCH")
+
+STREAM_CHUNK_SIZE = int(environ.get('BUNNY_STREAM_CHUNK_SIZE', 64 * 1024)) # Bytes forwarded per chunk when passing upstream bodies through.
+
+LIBRARY_KEY_CACHE_TTL = float(environ.get('BUNNY_LIBRARY_KEY_CACHE_TTL', 300))
+LIBRARY_KEY_CACHE_SIZE = int(environ.get('BUNNY_LIBRARY_KEY_CACHE_SIZE', 1024))
+
+library_api_keys = Caching.TTLCache(maxsize = LIBRARY_KEY_CACHE_SIZE, ttl = LIBRARY_KEY_CACHE_TTL)
+library_api_key_lookups = Caching.SingleFlight()
+
+COALESCE_TIMEOUT = float(environ.get('BUNNY_COALESCE_TIMEOUT', 10)) # Seconds a coalesced request waits on a shared upstream call before making its own.
+
+upstream_calls = Caching.SingleFlight() # Identical in-flight GETs of routes with "coalesce" metadata.
+
+RATE_LIMIT_KEY = float(environ.get('BUNNY_RATE_LIMIT_KEY', 25))          # Upstream requests per second per AccessKey.
+RATE_LIMIT_HOST = float(environ.get('BUNNY_RATE_LIMIT_HOST', 100))       # Upstream requests per second per upstream host.
+RATE_LIMIT_MAX_WAIT = float(environ.get('BUNNY_RATE_LIMIT_MAX_WAIT', 5)) # Seconds a request may queue before being shed with a 429.
+RATE_LIMIT_MAX_QUEUE = int(environ.get('BUNNY_RATE_LIMIT_MAX_QUEUE', 200))
+
+upstream_scheduler = Throttling.RequestScheduler(
+    key_rate = RATE_LIMIT_KEY,
+    host_rate = RATE_LIMIT_HOST,
+    max_wait = RATE_LIMIT_MAX_WAIT,
+    max_queue = RATE_LIMIT_MAX_QUEUE
+)
+
+PAGINATION_PAGE_SIZE = int(environ.get('BUNNY_PAGINATION_PAGE_SIZE', 100)) # itemsPerPage used when walking every page of a list upstream.
+
+PURGE_RATE = float(environ.get('BUNNY_PURGE_RATE', 20))                 # Purge calls per second sent by bulk purges.
+PURGE_CONCURRENCY = int(environ.get('BUNNY_PURGE_CONCURRENCY', 8))     # Purge calls in flight per bulk purge.
+PURGE_MAX_URLS = int(environ.get('BUNNY_PURGE_MAX_URLS', 10000))       # URLs accepted per bulk purge.
+
+purge_rate_limit = Throttling.TokenBucket(rate = PURGE_RATE)
+purge_jobs = Caching.TTLCache(maxsize = 256, ttl = 86400) # jobId -> outcome of finished bulk purges started with "async": true.
+running_purge_jobs = {}                                   # jobId -> progress of running ones, never evicted.
+
+BULK_MAX_IDS = int(environ.get('BUNNY_BULK_MAX_IDS', 100))        # Video IDs accepted per bulk request.
+BULK_CONCURRENCY = int(environ.get('BUNNY_BULK_CONCURRENCY', 8))  # Upstream calls in flight per bulk request.
+
+CAPTION_BATCH_MAX_ITEMS = int(environ.get('BUNNY_CAPTION_BATCH_MAX_ITEMS', 1000))    # Caption or transcription items accepted per batch.
+CAPTION_BATCH_CONCURRENCY = int(environ.get('BUNNY_CAPTION_BATCH_CONCURRENCY', 8))   # Upstream calls in flight per batch.
+CAPTION_BATCH_ATTEMPTS = int(environ.get('BUNNY_CAPTION_BATCH_ATTEMPTS', 3))         # Attempts per item on 5xx answers and transport errors.
+CAPTION_BATCH_MAX_WAIT = float(environ.get('BUNNY_CAPTION_BATCH_MAX_WAIT', 60))      # Seconds an item may wait out rate limits and open circuits.
+
+UPLOAD_CHUNK_SIZE = int(environ.get('BUNNY_UPLOAD_CHUNK_SIZE', 1024 * 1024)) # Bytes read from the client and sent to Bunny at a time.
+UPLOAD_TIMEOUT = float(environ.get('BUNNY_UPLOAD_TIMEOUT', 300))            # Seconds Bunny may take to answer once an upload is sent.
+
+UPLOAD_SIGNATURE_TTL = float(environ.get('BUNNY_UPLOAD_SIGNATURE_TTL', 7200))    # Seconds a TUS upload signature stays valid.
+UPLOAD_SIGNATURE_MAX_IDS = int(environ.get('BUNNY_UPLOAD_SIGNATURE_MAX_IDS', 1000)) # Video IDs accepted per batch signature request.
+upload_signature_prefixes = Caching.TTLCache(maxsize = LIBRARY_KEY_CACHE_SIZE, ttl = LIBRARY_KEY_CACHE_TTL) # (libraryId, apiKey) -> sha256 state.
+
+HEATMAP_CACHE_TTL = float(environ.get('BUNNY_HEATMAP_CACHE_TTL', 60))     # Seconds a fetched heatmap is reused for downsampled responses.
+HEATMAP_CACHE_SIZE = int(environ.get('BUNNY_HEATMAP_CACHE_SIZE', 512))
+HEATMAP_MAX_BUCKETS = int(environ.get('BUNNY_HEATMAP_MAX_BUCKETS', 10000))
+HEATMAP_AGGREGATES = {
+    "mean": lambda window: sum(window) / len(window),
+    "max": max,
+    "sum": sum
 }
+video_heatmaps = Caching.TTLCache(maxsize = HEATMAP_CACHE_SIZE, ttl = HEATMAP_CACHE_TTL) # (libraryId, videoId) -> views per second.
+
+STATISTICS_MAX_LIBRARIES = int(environ.get('BUNNY_STATISTICS_MAX_LIBRARIES', 100))  # Libraries accepted per statistics rollup.
+STATISTICS_CONCURRENCY = int(environ.get('BUNNY_STATISTICS_CONCURRENCY', 8))       # Upstream calls in flight per rollup.
+STATISTICS_CACHE_TTL = float(environ.get('BUNNY_STATISTICS_CACHE_TTL', 300))          # Seconds still-open days and other queries are kept.
+STATISTICS_OPEN_DAYS = int(environ.get('BUNNY_STATISTICS_OPEN_DAYS', 1))               # Days before today that are refetched after the TTL.
+STATISTICS_DEFAULT_DAYS = 30 # Range rolled up when no dateFrom is given.
+STATISTICS_MAX_DAYS = int(environ.get('BUNNY_STATISTICS_MAX_DAYS', 366))              # Longest range assembled from daily documents.
+STATISTICS_TOP_UP_DAYS = int(environ.get('BUNNY_STATISTICS_TOP_UP_DAYS', 3))           # Missing days fetched one by one; more cost one range query.
+STATISTICS_AVERAGED_FIELDS = ("engagementScore",) # Fields that are averaged rather than summed across libraries.
+library_statistics = Caching.TTLCache(maxsize = 1024, ttl = STATISTICS_CACHE_TTL) # (libraryId, query) -> document of a non-daily query.
+library_daily_statistics = Caching.DailyDocumentStore(open_days = STATISTICS_OPEN_DAYS, open_ttl = STATISTICS_CACHE_TTL) # libraryId -> day -> document.
+
+STORAGE_STATISTICS_OPEN_DAYS = int(environ.get('BUNNY_STORAGE_STATISTICS_OPEN_DAYS', 1))   # Days before today that are still refetched.
+STORAGE_STATISTICS_DEFAULT_DAYS = 30  # Range served when no dateFrom is given.
+STORAGE_STATISTICS_MAX_DAYS = int(environ.get('BUNNY_STORAGE_STATISTICS_MAX_DAYS', 366))
+storage_zone_statistics = Caching.DailySeriesStore(open_days = STORAGE_STATISTICS_OPEN_DAYS) # storageZoneId -> daily points.
+
+UPSTREAM_ERRORS = ( # (exception type, status, message), most specific first.
+    (Throttling.UpstreamThrottled, 429, "Too many requests to Bunny, retry later"),
+    (Resilience.CircuitOpen, 503, "Bunny is currently unavailable, retry later"),
+    (requests.ConnectionError, 502, "Bunny could not be reached"),
+    (requests.Timeout, 504, "Bunny did not respond in time")
+)
 
 class RESPONSEDATA:
     def __init__(self) -> None:
         return None
 
-def get_bunny_api_status() -> int:
-    '''Returns the status code of a GET request to https://api.bunny.net'''
-    bunny_api_response: requests.Response = make_api_request(
-        url = "https://api.bunny.net",
-        method = "GET"
-    )
-    return bunny_api_response.status_code
+def replay_key(method: str, url: str, headers: dict, data = None, json_body = None) -> tuple:
+    '''
+    Identifies an upstream call among the responses the async engine replays a route with. The AccessKey and a digest
+    of the body are part of it, so a call retried with a refreshed key or a different body is never answered from the earlier one.
+    '''
+    if json_body is not None:
+        body = json.dumps(json_body, sort_keys = True, default = str).encode()
+    elif isinstance(data, str):
+        body = data.encode()
+    elif isinstance(data, bytes):
+        body = data
+    elif data:
+        body = json.dumps(data, sort_keys = True, default = str).encode()
+    else:
+        body = b""
+    return (method, url, headers.get("AccessKey"), hashlib.sha256(body).hexdigest())
 
-def retrieve_library_api_key(libraryId: str):
-    '''Retrieves the API key specific to the given Library'''
+class UpstreamCall:
+    '''An upstream call captured from route code while it runs under the async engine (`AsyncAPI.py`).'''
+    def __init__(self, url: str, method: str, data = None, json = None, headers = None, coalesce_timeout: float = None,
+                 policy: Resilience.UpstreamPolicy = None, stream: bool = False) -> None:
+        self.url = url
+        self.method = method
+        self.data = data
+        self.json = json
+        self.headers = headers
+        self.coalesce_timeout = coalesce_timeout
+        self.policy = policy or Resilience.default_policy
+        self.stream = stream
+
+    @property
+    def key(self) -> tuple:
+        return replay_key(self.method, self.url, self.headers, self.data, self.json)
+
+class UpstreamRequest(BaseException):
+    '''
+    Raised by `make_api_request` when a route is run by the async engine and an upstream response is not known yet.
+    The engine performs the pending `calls` without blocking and replays the route with the responses in `upstream_replay`.
+    This derives from `BaseException` so route code and Flask's error handling never swallow it.
+    '''
+    def __init__(self, calls: list, max_concurrency: int = None) -> None:
+        super().__init__(calls)
+        self.calls = calls
+        self.max_concurrency = max_concurrency
+
+upstream_replay = contextvars.ContextVar("upstream_replay", default = None) # `replay_key` -> requests.Response, set by the async engine.
+
+def fetch_library_api_key(libraryId: str):
+    '''Fetches the API key specific to the given Library from Bunny, bypassing the key cache'''
     bunny_api_response = make_api_request(
         url = f"https://api.bunny.net/videolibrary/{libraryId}?includeAccessKey=true",
-        method = "GET"
+        method = "GET",
+        stream = False
     )
     bunny_api_response = bunny_api_response.json()
 
     api_key = bunny_api_response.get("ApiKey")
     if api_key is not None:
+        library_api_keys.set(libraryId, api_key)
         return api_key
     else:
         return None
 
+def retrieve_library_api_key(libraryId: str):
+    '''
+    Retrieves the API key specific to the given Library.
+    Keys are served from `library_api_keys` when possible; concurrent misses for one library share a single upstream lookup.
+    '''
+    api_key = library_api_keys.get(libraryId)
+    if api_key is not None:
+        return api_key
+    return library_api_key_lookups.do(libraryId, lambda: fetch_library_api_key(libraryId))
+
+def retrieve_library_api_keys(libraryIds: list, max_workers: int) -> dict:
+    '''
+    Retrieves the API keys of several Libraries, looking the uncached ones up concurrently. Unknown libraries map to `None`,
+    libraries whose lookup failed to the `requests.RequestException` it failed with.
+    '''
+    api_keys = {libraryId: library_api_keys.get(libraryId) for libraryId in libraryIds}
+    missing = [libraryId for libraryId, api_key in api_keys.items() if api_key is None]
+    bunny_api_responses = make_api_requests(
+        [
+            {
+                "url": f"https://api.bunny.net/videolibrary/{libraryId}?includeAccessKey=true",
+                "method": "GET"
+            }
+            for libraryId in missing
+        ],
+        max_workers = max_workers
+    )
+    for libraryId, bunny_api_response in zip(missing, bunny_api_responses):
+        if isinstance(bunny_api_response, requests.RequestException):
+            api_keys[libraryId] = bunny_api_response
+            continue
+        api_key = bunny_api_response.json().get("ApiKey") if bunny_api_response.status_code == 200 else None
+        if api_key is not None:
+            library_api_keys.set(libraryId, api_key)
+        api_keys[libraryId] = api_key
+    return api_keys
+
+def invalidate_library_api_key(libraryId: str) -> None:
+    '''Drops the cached API key of the given Library, forcing the next request to look it up again.'''
+    library_api_keys.pop(libraryId)
+
 def require_library_api_key(func):
     '''
     Function decorator to append `_library_api_key` as a kwarg to a function call.
     Retrieves the API key for the given `libraryId` func kwarg.
+    If Bunny rejects a cached key with a 401 the key is looked up again and the call is retried once.
     '''
     def wrapper(*args, **kwargs):
-        kwargs['_library_api_key'] = retrieve_library_api_key(kwargs['libraryId'])
+        libraryId = kwargs['libraryId']
+        was_cached = libraryId in library_api_keys
+
+        kwargs['_library_api_key'] = retrieve_library_api_key(libraryId)
         result = func(
             *args, **kwargs
         )
+
+        # A request body that was streamed upstream can't be sent a second time.
+        if was_cached and getattr(result, "status_code", None) == 401 and not g.get("request_body_consumed", False):
+            result.close() # Gives back the connection of the rejected response, whose body is never sent.
+            invalidate_library_api_key(libraryId)
+            kwargs['_library_api_key'] = retrieve_library_api_key(libraryId)
+            result = func(
+                *args, **kwargs
+            )
         return result
     wrapper.__name__ = func.__name__
     return wrapper
 
-def make_api_request(url: str, method: str, data = None, json = None, headers = None):
-    """Makes a request to Bunny's API, autofilling required structural headers (These can be overridden by manually specifying them in the `headers` parameter.)"""
+def build_request_headers(headers = None) -> dict:
+    '''Headers sent with every Bunny API request, overridden by anything given in `headers`.'''
     request_headers = {
         "AccessKey": ACCOUNT_API_KEY,
         "accept": "application/json"
@@ -73,24 +259,304 @@ def make_api_request(url: str, method: str, data = None, json = None, headers =
     if headers is not None:
         for key in headers:
             request_headers[key] = headers[key]
+    return request_headers
+
+def make_api_request(url: str, method: str, data = None, json = None, headers = None, stream: bool = False,
+                     policy: Resilience.UpstreamPolicy = None):
+    """
+    Makes a request to Bunny's API, autofilling required structural headers (These can be overridden by manually specifying them in the `headers` parameter.)
+    With `stream` the body is left on the socket until it is read, so `make_api_response` can forward it without buffering.
+    A streamed response holds its pooled connection until it is closed, so only pass-through routes that hand it straight to `make_api_response` ask for one.
+    Timeouts, retries and hedging follow `policy`, by default the one of the current route (see `request_upstream_policy`).
+    """
+    request_headers = build_request_headers(headers)
     
-    call = method_map[method]
-    response = call(
-        url, headers=request_headers, data=data, json=json
-    )
+    if method not in allowed_methods:
+        raise ValueError(f"Unsupported HTTP method: {method}")
+
+    coalesce_timeout = request_coalesce_timeout() if method == "GET" else None
+    policy = policy or request_upstream_policy()
+
+    replay = upstream_replay.get()
+    if replay is not None:
+        response = replay.get(replay_key(method, url, request_headers, data, json))
+        if response is None:
+            raise UpstreamRequest([
+                UpstreamCall(url, method, data = data, json = json, headers = request_headers, coalesce_timeout = coalesce_timeout, policy = policy, stream = stream)
+            ])
+        if isinstance(response, requests.RequestException):
+            raise response
+        return response
+
+    if coalesce_timeout is not None:
+        # Shared responses must be fully read, since every waiting request forwards the same body.
+        return upstream_calls.do(
+            (method, url, request_headers["AccessKey"]),
+            lambda: send_api_request(url, method, request_headers, data = data, json = json, stream = False, policy = policy),
+            timeout = coalesce_timeout
+        )
+
+    response = send_api_request(url, method, request_headers, data = data, json = json, stream = stream, policy = policy)
+    if stream and has_request_context():
+        g.setdefault("streamed_responses", []).append(response) # Closed at teardown unless `make_api_response` takes it over.
+    return response
+
+def send_api_request(url: str, method: str, request_headers: dict, data = None, json = None, stream: bool = False,
+                     policy: Resilience.UpstreamPolicy = Resilience.default_policy) -> requests.Response:
+    '''
+    Sends a request under `policy`: idempotent calls that time out, fail to connect or get a 502/503/504 are retried
+    with jittered exponential backoff, and hedged GETs are sent a second time when the first is slower than the route's p95.
+    '''
+    attempts = policy.attempts(method)
+    for attempt in range(attempts):
+        last_attempt = attempt == attempts - 1
+        hedge_after = policy.hedge_delay(method)
+        try:
+            if hedge_after is not None:
+                # Racing attempts must be fully read, so that "first" means the first complete reply.
+                response = Resilience.hedged(
+                    lambda: send_api_request_once(url, method, request_headers, data = data, json = json, stream = False, policy = policy),
+                    hedge_after
+                )
+            else:
+                response = send_api_request_once(url, method, request_headers, data = data, json = json, stream = stream, policy = policy)
+        except (requests.ConnectionError, requests.Timeout):
+            if last_attempt:
+                raise
+        else:
+            if last_attempt or response.status_code not in Resilience.RETRYABLE_STATUS_CODES:
+                return response
+            response.close()
+        time.sleep(policy.backoff_delay(attempt))
+
+def send_api_request_once(url: str, method: str, request_headers: dict, data = None, json = None, stream: bool = False,
+                          policy: Resilience.UpstreamPolicy = Resilience.default_policy) -> requests.Response:
+    '''
+    Sends one request on the pooled session once `upstream_scheduler` admits it and the upstream's circuit breaker is
+    closed (raising `Resilience.CircuitOpen` otherwise), recording its outcome, latency and any 429 it gets back.
+    '''
+    breaker = policy.breaker(url)
+    upstream_scheduler.admit(request_headers["AccessKey"], urlsplit(url).netloc)
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        response = Sessions.get_session(url).request(
+            method, url, headers=request_headers, data=data, json=json, stream=stream, timeout=policy.timeout
+        )
+    except Exception as e:
+        breaker.after_call(Resilience.is_failure(e), time.monotonic() - started)
+        raise
+    elapsed = time.monotonic() - started
+    breaker.after_call(Resilience.is_failure(response), elapsed)
+    Resilience.latencies.record(policy.name, elapsed)
+    upstream_scheduler.record_response(request_headers["AccessKey"], response.status_code, response.headers.get("Retry-After"))
     return response
 
+def make_api_requests(calls: list, max_workers: int) -> list:
+    '''
+    Makes several independent Bunny API requests concurrently, returning their fully read responses in order.
+    Each call is a dict of `make_api_request` keyword arguments. At most `max_workers` requests are in flight at once.
+    A call that fails in transport (or is refused by the scheduler or a breaker) gets its `requests.RequestException`
+    in place of a response, so one failure never sinks the others; `upstream_error` describes it for a per-item error.
+    '''
+    if not calls:
+        return []
+
+    policy = request_upstream_policy() # Worker threads have no request context, so the route's policy is resolved here.
+    replay = upstream_replay.get()
+    if replay is not None:
+        captured = [
+            UpstreamCall(call["url"], call["method"], data = call.get("data"), json = call.get("json"), headers = build_request_headers(call.get("headers")), policy = policy)
+            for call in calls
+        ]
+        pending = [call for call in captured if call.key not in replay]
+        if pending:
+            raise UpstreamRequest(pending, max_concurrency = max_workers)
+        return [replay[call.key] for call in captured]
+
+    def make_call(call: dict):
+        try:
+            return make_api_request(**call, stream = False, policy = policy)
+        except requests.RequestException as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers = max(1, min(max_workers, len(calls)))) as executor:
+        return list(executor.map(make_call, calls))
+
+def upstream_error(error: requests.RequestException) -> dict:
+    '''The per-item error entry for an upstream call that failed with `error`, mirroring the status codes of `API.py`'s error handlers.'''
+    for error_type, status, message in UPSTREAM_ERRORS:
+        if isinstance(error, error_type):
+            return {"status": status, "message": message}
+    return {"status": 502, "message": "Bunny could not be reached"}
+
+def retry_upstream_call(send, attempts: int, max_wait: float, policy: Resilience.UpstreamPolicy = None,
+                        retry_unauthorized = None, stop: threading.Event = None) -> tuple:
+    '''
+    Calls `send()`, which makes one upstream request for an item of a batch, until it gets a 2xx or 3xx answer, a 4xx answer,
+    or `attempts` tries have failed on transport errors and 5xx answers. Rate limits and open circuits are waited out without
+    using attempts, up to `max_wait` seconds in all. A 401 is tried again when `retry_unauthorized()` returns True (after
+    refreshing the key), and every wait ends early once `stop` is set. Returns (last status, attempts used, last error).
+    '''
+    policy = policy or Resilience.default_policy
+    wait = stop.wait if stop is not None else time.sleep
+    used = 0
+    waited = 0.0
+    status = None
+    error = None
+    while used < attempts and not (stop is not None and stop.is_set()):
+        try:
+            bunny_api_response = send()
+        except (Throttling.UpstreamThrottled, Resilience.CircuitOpen) as e:
+            if waited + e.retry_after > max_wait:
+                failure = upstream_error(e)
+                return failure["status"], used, failure["message"]
+            waited += e.retry_after
+            wait(e.retry_after)
+            continue
+        except requests.RequestException as e:
+            used += 1
+            status, error = None, type(e).__name__
+            if used < attempts:
+                wait(policy.backoff_delay(used))
+            continue
+
+        status = bunny_api_response.status_code
+        if status == 401 and retry_unauthorized is not None and retry_unauthorized():
+            continue
+        if status == 429:
+            # The scheduler holds the key back for its Retry-After, so the next call waits in `send()`.
+            waited += Throttling.parse_retry_after(bunny_api_response.headers.get("Retry-After"), 1.0)
+            if waited > max_wait:
+                return status, used, bunny_api_response.text[:500]
+            continue
+        used += 1
+        if status < 400:
+            return status, used, None
+        error = bunny_api_response.text[:500]
+        if status < 500:
+            break
+        if used < attempts:
+            wait(policy.backoff_delay(used))
+    return status, used, error
+
+def request_id_list(field: str, label: str, maximum: int) -> tuple:
+    '''
+    Reads the IDs of a bulk route from `?<field>=a,b,c`, or from a POST body of `{"<field>": [...]}` for lists too long for a URL.
+    Returns the unique IDs in request order and `None`, or `None` and the 400 response explaining what is wrong with them.
+    '''
+    if request.method == "POST":
+        ids = (request.get_json(silent = True) or {}).get(field)
+    else:
+        ids = request.args.get(field, "").split(",")
+
+    if not isinstance(ids, list):
+        return None, make_response(jsonify(f"{label[0].upper() + label[1:]} must be given as ?{field}=a,b,c or a JSON body of {{\"{field}\": [...]}}"), 400)
+    ids = list(dict.fromkeys(str(value).strip() for value in ids if str(value).strip()))
+    if len(ids) == 0:
+        return None, make_response(jsonify(f"No {label} were given"), 400)
+    if len(ids) > maximum:
+        return None, make_response(jsonify(f"At most {maximum} {label} can be given at once"), 400)
+    return ids, None
+
+def request_coalesce_timeout():
+    '''Returns the coalescing wait timeout when the current route opts in through "coalesce" metadata, otherwise `None`.'''
+    if not has_request_context():
+        return None
+    coalesce = (getattr(request, "metadata", None) or {}).get("coalesce")
+    if coalesce is None:
+        return None
+    return coalesce.get("timeout", COALESCE_TIMEOUT)
+
+def request_upstream_policy() -> Resilience.UpstreamPolicy:
+    '''Returns the timeout, retry and hedging policy of the current route, from its "upstream" metadata.'''
+    if not has_request_context() or request.url_rule is None:
+        return Resilience.default_policy
+    return Resilience.UpstreamPolicy.from_metadata(
+        getattr(request, "metadata", None),
+        name = f"{request.method} {request.url_rule.rule}"
+    )
+
+def stream_upstream_body(bunny_response: requests.Response):
+    '''Yields the upstream body chunk by chunk, returning the connection to the pool once it is exhausted.'''
+    try:
+        for chunk in bunny_response.iter_content(chunk_size = STREAM_CHUNK_SIZE):
+            yield chunk
+    finally:
+        bunny_response.close()
+
+def stream_all_pages(url: str, headers: dict):
+    '''
+    Walks every page of a Bunny list endpoint server-side and streams its items to the client as NDJSON.
+    The client's query string is forwarded except for paging parameters. The next page is fetched while the current
+    one is being written, so at most two pages are held in memory regardless of the list's size.
+    A later page that fails ends the stream with an `{"error": {"page": ..., "status": ...}}` line.
+    '''
+    query = [(key, value) for key, value in request.args.items(multi = True) if key not in ("all", "page", "itemsPerPage")]
+
+    def fetch_page(page: int) -> requests.Response:
+        return make_api_request(
+            url = url + "?" + urlencode(query + [("page", page), ("itemsPerPage", PAGINATION_PAGE_SIZE)]),
+            method = "GET",
+            headers = headers,
+            stream = False
+        )
+
+    first_page = fetch_page(1)
+    if first_page.status_code != 200:
+        return make_api_response(first_page, request.metadata)
+
+    def generate():
+        with ThreadPoolExecutor(max_workers = 1) as prefetcher:
+            page = 1
+            bunny_api_response = first_page
+            while True:
+                body = bunny_api_response.json()
+                items = body.get("items") or []
+                has_more = len(items) > 0 and page * PAGINATION_PAGE_SIZE < body.get("totalItems", 0)
+                if has_more:
+                    next_page = prefetcher.submit(fetch_page, page + 1)
+
+                for item in items:
+                    yield json.dumps(item) + "\n"
+                if not has_more:
+                    return
+
+                page += 1
+                try:
+                    bunny_api_response = next_page.result()
+                except requests.RequestException as e:
+                    yield json.dumps({"error": {"page": page, "status": upstream_error(e)["status"]}}) + "\n"
+                    return
+                if bunny_api_response.status_code != 200:
+                    yield json.dumps({"error": {"page": page, "status": bunny_api_response.status_code}}) + "\n"
+                    return
+
+    return Response(generate(), mimetype = "application/x-ndjson")
+
 def make_api_response(bunny_response: requests.Response, metadata: dict):
-    """Makes a response for *this* API, using the route's defined response metadata & a Bunny API response to construct it properly."""
+    """
+    Makes a response for *this* API, using the route's defined response metadata & a Bunny API response to construct it properly.
+    `RESPONSEDATA` bodies are passed through byte for byte with Bunny's Content-Type; they are never parsed here.
+    The upstream response is closed once the client response is, even when its body is never iterated (HEAD requests,
+    clients that hang up, responses discarded by a retry), so its pooled connection is always given back.
+    """
+    streamed_responses = g.get("streamed_responses", []) if has_request_context() else []
+    if bunny_response in streamed_responses:
+        streamed_responses.remove(bunny_response)
     route_response = metadata['responses'].get(
         bunny_response.status_code, "Unknown response code."
     )
 
     if route_response is RESPONSEDATA:
-        api_response = make_response(
-            jsonify(bunny_response.json())
+        api_response = Response(
+            stream_upstream_body(bunny_response),
+            content_type = bunny_response.headers.get("Content-Type", "application/json")
         )
+        api_response.call_on_close(bunny_response.close)
     else:
+        bunny_response.content # Drain the unused body so the connection can be reused.
+        bunny_response.close()
         api_response = make_response(
             jsonify(route_response)
         )
@@ -103,7 +569,8 @@ def GetCountryList():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/country",
         method = str(request.method),
-        data = request.data
+        data = request.data,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -115,7 +582,8 @@ def ListAPIKeys():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/apikey" + query_string,
         method = str(request.method),
-        data = request.data
+        data = request.data,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -123,7 +591,8 @@ def ListRegions():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/region",
         method = str(request.method),
-        data = request.data
+        data = request.data,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -135,7 +604,8 @@ def ListVideoLibraries():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/videolibrary" + query_string,
         method = str(request.method),
-        data = request.data
+        data = request.data,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -143,7 +613,8 @@ def AddVideoLibrary():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/videolibrary",
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -155,7 +626,8 @@ def GetVideoLibrary(libraryId):
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/videolibrary/" + libraryId + query_string,
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -167,7 +639,8 @@ def UpdateVideoLibrary(libraryId):
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/videolibrary/" + libraryId + query_string,
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -175,15 +648,18 @@ def DeleteVideoLibrary(libraryId):
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/videolibrary/" + libraryId,
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
+    invalidate_library_api_key(libraryId)
     return make_api_response(bunny_api_response, request.metadata)
 
 def GetLanguages():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/videolibrary/languages",
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -191,8 +667,10 @@ def ResetVideoLibraryApiKey(libraryId):
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/videolibrary/" + libraryId + "/resetApiKey",
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
+    invalidate_library_api_key(libraryId)
     return make_api_response(bunny_api_response, request.metadata)
 
 def Purge():
@@ -203,10 +681,158 @@ def Purge():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/purge" + query_string,
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
+def deduplicate_purge_urls(urls: list) -> tuple:
+    '''
+    Drops repeated URLs and URLs already covered by a wildcard (`*`) pattern of the same request.
+    Returns the URLs left to purge, in request order, and a mapping of every skipped URL to the reason it was skipped.
+    '''
+    skipped = {}
+    unique = []
+    seen = set()
+    for url in urls:
+        url = url.strip()
+        if url == "":
+            continue
+        if url in seen:
+            skipped[url] = "duplicate"
+            continue
+        seen.add(url)
+        unique.append(url)
+
+    def is_trailing(pattern):
+        return pattern.endswith("*") and pattern.count("*") == 1
+
+    # Trailing wildcards are kept as sorted prefixes, none of which starts with another: a prefix covering some text
+    # can then only be the last kept prefix sorting before it.
+    prefixes = []
+    for pattern in sorted((url for url in unique if is_trailing(url)), key = lambda pattern: pattern[:-1]):
+        if prefixes and pattern.startswith(prefixes[-1]):
+            skipped[pattern] = f"covered by {prefixes[-1]}*"
+        else:
+            prefixes.append(pattern[:-1])
+
+    def covering_prefix(text):
+        index = bisect.bisect_right(prefixes, text) - 1
+        if index >= 0 and text.startswith(prefixes[index]):
+            return prefixes[index] + "*"
+        return None
+
+    # Wildcards elsewhere in the URL are rare and compared as regular expressions, broader (shorter) ones first.
+    patterns = {}
+    for pattern in sorted((url for url in unique if "*" in url and not is_trailing(url)), key = len):
+        covering = covering_prefix(pattern.split("*", 1)[0]) or next(
+            (kept for kept, regex in patterns.items() if regex.fullmatch(pattern)), None)
+        if covering is not None:
+            skipped[pattern] = f"covered by {covering}"
+        else:
+            patterns[pattern] = re.compile(".*".join(re.escape(part) for part in pattern.split("*")))
+
+    def covering_pattern(url):
+        return next((kept for kept, regex in patterns.items() if regex.fullmatch(url)), None)
+
+    kept_prefixes = set(prefixes)
+    to_purge = []
+    for url in unique:
+        if is_trailing(url):
+            if url[:-1] not in kept_prefixes:
+                continue
+            covering = covering_pattern(url)
+        elif "*" in url:
+            if url not in patterns:
+                continue
+            covering = None
+        else:
+            covering = covering_prefix(url) or covering_pattern(url)
+        if covering is not None:
+            skipped[url] = f"covered by {covering}"
+        else:
+            to_purge.append(url)
+    return to_purge, skipped
+
+def purge_url(url: str) -> dict:
+    '''Purges one URL (or wildcard pattern) once the bulk purge rate limit allows it.'''
+    purge_rate_limit.acquire()
+    try:
+        bunny_api_response = make_api_request(
+            url = "https://api.bunny.net/purge?" + urlencode({"url": url, "async": "false"}),
+            method = "POST",
+            stream = False
+        )
+    except requests.RequestException as e:
+        return {"url": url, "status": None, "error": type(e).__name__}
+    return {"url": url, "status": bunny_api_response.status_code}
+
+def run_bulk_purge(urls: list, on_result = None) -> list:
+    '''Purges `urls` concurrently (bounded by `PURGE_CONCURRENCY`), calling `on_result` as each one finishes.'''
+    results = []
+    with ThreadPoolExecutor(max_workers = max(1, min(PURGE_CONCURRENCY, len(urls)))) as executor:
+        for result in executor.map(purge_url, urls):
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+    return results
+
+def summarize_purge(results: list, skipped: dict, total: int) -> dict:
+    purged = sum(1 for result in results if result["status"] == 200)
+    return {
+        "total": total,
+        "done": len(results),
+        "purged": purged,
+        "failed": len(results) - purged,
+        "skipped": skipped,
+        "results": results
+    }
+
+def BulkPurge():
+    '''
+    Purges a JSON body of `{"urls": [...], "async": false}` in one call.
+    Duplicates and URLs covered by a wildcard in the same request are skipped; the rest are purged concurrently within
+    `PURGE_RATE`. With `"async": true` a job ID is returned immediately and progress can be polled from `/purge/bulk/<jobId>`.
+    '''
+    body = request.get_json(silent = True) or {}
+    urls = body.get("urls")
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        return make_response(jsonify("The request body must contain a \"urls\" array of URLs or wildcard patterns"), 400)
+    if len(urls) > PURGE_MAX_URLS:
+        return make_response(jsonify(f"At most {PURGE_MAX_URLS} URLs can be purged at once"), 400)
+
+    to_purge, skipped = deduplicate_purge_urls(urls)
+
+    if not body.get("async", False):
+        return jsonify(summarize_purge(run_bulk_purge(to_purge), skipped, len(to_purge)))
+
+    job_id = uuid.uuid4().hex
+    results = []
+    running_purge_jobs[job_id] = {"status": "running", "results": results, "skipped": skipped, "total": len(to_purge)}
+
+    def run_job():
+        try:
+            run_bulk_purge(to_purge, on_result = results.append)
+            status = "finished"
+        except Exception:
+            status = "failed"
+        purge_jobs.set(job_id, {"status": status, "results": results, "skipped": skipped, "total": len(to_purge)})
+        running_purge_jobs.pop(job_id, None)
+
+    threading.Thread(target = run_job, name = f"bulk-purge-{job_id}", daemon = True).start()
+    return make_response(jsonify({"jobId": job_id, "status": "running", "total": len(to_purge), "skipped": skipped}), 202)
+
+def GetBulkPurgeJob(jobId):
+    '''Reports the progress of a bulk purge started with `"async": true` by this worker process.'''
+    job = running_purge_jobs.get(jobId) or purge_jobs.get(jobId)
+    if job is None:
+        return make_response(jsonify(request.metadata['responses'][404]), 404)
+    return jsonify(dict(
+        summarize_purge(list(job["results"]), job["skipped"], job["total"]),
+        jobId = jobId,
+        status = job["status"]
+    ))
+
 def ListStorageZones():
     if request.query_string.decode() != "":
         query_string = f"?{request.query_string.decode()}"
@@ -215,7 +841,8 @@ def ListStorageZones():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/storagezone" + query_string,
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -223,7 +850,8 @@ def AddStorageZone():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/storagezone",
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -231,7 +859,8 @@ def CheckStorageZoneAvailability():
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/storagezone/checkavailability",
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -239,7 +868,8 @@ def GetStorageZone(storageZoneId):
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/storagezone/" + storageZoneId,
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -247,7 +877,8 @@ def UpdateStorageZone(storageZoneId):
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/storagezone/" + storageZoneId,
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -255,22 +886,61 @@ def DeleteStorageZone(storageZoneId):
     bunny_api_response = make_api_request(
         url = "https://api.bunny.net/storagezone/" + storageZoneId,
         method = str(request.method),
-        json = request.json
+        json = request.json,
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
 def GetStorageZoneStatistics(storageZoneId):
-    if request.query_string.decode() != "":
-        query_string = f"?{request.query_string.decode()}"
-    else:
-        query_string = ""
+    '''
+    Serves storage zone statistics for `dateFrom`..`dateTo` from `storage_zone_statistics`, asking Bunny only for the
+    days it hasn't stored yet and for the still-open trailing window. Other query parameters are proxied as-is.
+    '''
+    if any(key not in ("dateFrom", "dateTo") for key in request.args):
+        bunny_api_response = make_api_request(
+            url = f"https://api.bunny.net/storagezone/{storageZoneId}/statistics?{request.query_string.decode()}",
+            method = str(request.method),
+            json = request.json,
+            stream = True
+        )
+        return make_api_response(bunny_api_response, request.metadata)
 
-    bunny_api_response = make_api_request(
-        url = f"https://api.bunny.net/storagezone/{storageZoneId}/statistics" + query_string,
-        method = str(request.method),
-        json = request.json
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    try:
+        last = datetime.date.fromisoformat(request.args["dateTo"][:10]) if "dateTo" in request.args else today
+        first = (
+            datetime.date.fromisoformat(request.args["dateFrom"][:10]) if "dateFrom" in request.args
+            else last - datetime.timedelta(days = STORAGE_STATISTICS_DEFAULT_DAYS - 1)
+        )
+    except ValueError:
+        return make_response(jsonify("dateFrom and dateTo must be ISO 8601 dates"), 400)
+    if first > last or (last - first).days >= STORAGE_STATISTICS_MAX_DAYS:
+        return make_response(jsonify(f"The date range must span between 1 and {STORAGE_STATISTICS_MAX_DAYS} days"), 400)
+
+    runs = storage_zone_statistics.missing_runs(storageZoneId, first, last, today)
+    bunny_api_responses = make_api_requests(
+        [
+            {
+                "url": f"https://api.bunny.net/storagezone/{storageZoneId}/statistics?" + urlencode({
+                    "dateFrom": run_first.isoformat(),
+                    "dateTo": run_last.isoformat()
+                }),
+                "method": "GET"
+            }
+            for run_first, run_last in runs
+        ],
+        max_workers = STATISTICS_CONCURRENCY
     )
-    return make_api_response(bunny_api_response, request.metadata)
+    for (run_first, run_last), bunny_api_response in zip(runs, bunny_api_responses):
+        if isinstance(bunny_api_response, requests.RequestException):
+            raise bunny_api_response # One document is served, so any missing run fails it as a whole.
+        if bunny_api_response.status_code != 200:
+            return make_api_response(bunny_api_response, request.metadata)
+        storage_zone_statistics.store(storageZoneId, run_first, run_last, bunny_api_response.json(), today)
+
+    api_response = make_response(jsonify(storage_zone_statistics.assemble(storageZoneId, first, last)))
+    api_response.headers["X-Statistics-Fetched-Days"] = str(sum((run_last - run_first).days + 1 for run_first, run_last in runs))
+    return api_response
 
 @require_library_api_key
 def GetCollection(libraryId, collectionId, _library_api_key):
@@ -285,7 +955,8 @@ def GetCollection(libraryId, collectionId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -298,7 +969,8 @@ def UpdateCollection(libraryId, collectionId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -310,12 +982,21 @@ def DeleteCollection(libraryId, collectionId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
 @require_library_api_key
 def ListCollections(libraryId, _library_api_key):
+    if request.args.get("all", "").lower() == "true":
+        return stream_all_pages(
+            f"https://video.bunnycdn.com/library/{libraryId}/collections",
+            headers = {
+                "AccessKey": _library_api_key
+            }
+        )
+
     if request.query_string.decode() != "":
         query_string = f"?{request.query_string.decode()}"
     else:
@@ -327,7 +1008,8 @@ def ListCollections(libraryId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -339,7 +1021,8 @@ def CreateCollection(libraryId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -351,10 +1034,56 @@ def GetVideo(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
+@require_library_api_key
+def GetVideosBulk(libraryId, _library_api_key):
+    '''
+    Fetches several videos of one library in a single call, from `?ids=a,b,c` or a POST body of `{"ids": [...]}`.
+    The library key is resolved once and the videos are fetched concurrently; failures are reported per ID.
+    '''
+    video_ids, problem = request_id_list("ids", "video IDs", BULK_MAX_IDS)
+    if problem is not None:
+        return problem
+
+    bunny_api_responses = make_api_requests(
+        [
+            {
+                "url": f"https://video.bunnycdn.com/library/{libraryId}/videos/{videoId}",
+                "method": "GET",
+                "headers": {
+                    "AccessKey": _library_api_key
+                }
+            }
+            for videoId in video_ids
+        ],
+        max_workers = BULK_CONCURRENCY
+    )
+
+    videos = {}
+    errors = {}
+    for videoId, bunny_api_response in zip(video_ids, bunny_api_responses):
+        if isinstance(bunny_api_response, requests.RequestException):
+            errors[videoId] = upstream_error(bunny_api_response)
+        elif bunny_api_response.status_code == 200:
+            videos[videoId] = bunny_api_response.json()
+        else:
+            errors[videoId] = {
+                "status": bunny_api_response.status_code,
+                "message": request.metadata['responses'].get(bunny_api_response.status_code, "Unknown response code.")
+            }
+
+    api_response = make_response(jsonify({
+        "videos": videos,
+        "errors": errors
+    }))
+    if len(videos) == 0 and all(error["status"] == 401 for error in errors.values()):
+        api_response.status_code = 401 # Lets `require_library_api_key` refresh a stale cached key.
+    return api_response
+
 @require_library_api_key
 def UpdateVideo(libraryId, videoId, _library_api_key):
     bunny_api_response = make_api_request(
@@ -363,7 +1092,8 @@ def UpdateVideo(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -375,21 +1105,156 @@ def DeleteVideo(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
+class UploadStream:
+    '''
+    The client's request body as an iterable of chunks of at most `chunk_size` bytes with a known length, so `requests`
+    forwards it to Bunny with a Content-Length while holding a single chunk in memory.
+    A client that disconnects mid-upload raises `ClientDisconnected`, which aborts the upstream transfer.
+    '''
+    def __init__(self, source, length: int, chunk_size: int = UPLOAD_CHUNK_SIZE) -> None:
+        self.source = source
+        self.length = length
+        self.chunk_size = chunk_size
+        self.sent = 0
+        self.started = None
+        self.finished = None
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        self.started = time.monotonic()
+        while self.sent < self.length:
+            chunk = self.source.read(min(self.chunk_size, self.length - self.sent))
+            if not chunk:
+                raise ClientDisconnected()
+            self.sent += len(chunk)
+            yield chunk
+        self.finished = time.monotonic()
+
+    def stats_headers(self) -> dict:
+        seconds = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+        return {
+            "X-Upload-Bytes": str(self.sent),
+            "X-Upload-Seconds": f"{seconds:.3f}",
+            "X-Upload-Throughput": str(int(self.sent / seconds)) if seconds > 0 else "0" # Bytes per second.
+        }
+
 @require_library_api_key
-def GetVideoHeatmap(libraryId, videoId, _library_api_key):
+def UploadVideo(libraryId, videoId, _library_api_key):
+    '''Streams the request body to Bunny as the video's file without buffering it, reporting the transfer in `X-Upload-*` headers.'''
+    if request.content_length is None:
+        return make_response(jsonify(request.metadata['responses'][411]), 411)
+
+    if request.query_string.decode() != "":
+        query_string = f"?{request.query_string.decode()}"
+    else:
+        query_string = ""
+
+    upload = UploadStream(request.stream, request.content_length)
+    g.request_body_consumed = True
     bunny_api_response = make_api_request(
-        url = f"https://video.bunnycdn.com/library/{libraryId}/videos/{videoId}/heatmap",
-        method = str(request.method),
-        json = request.json,
+        url = f"https://video.bunnycdn.com/library/{libraryId}/videos/{videoId}" + query_string,
+        method = "PUT",
+        data = upload,
         headers = {
-            "AccessKey": _library_api_key
-        }
+            "AccessKey": _library_api_key,
+            "Content-Type": "application/octet-stream"
+        },
+        stream = True
     )
-    return make_api_response(bunny_api_response, request.metadata)
+    api_response = make_api_response(bunny_api_response, request.metadata)
+    api_response.headers.update(upload.stats_headers())
+    return api_response
+
+@require_library_api_key
+def GetVideoHeatmap(libraryId, videoId, _library_api_key):
+    '''
+    Proxies the video's per-second heatmap. With `?buckets=N` (aggregated by `?aggregate=mean|max|sum`) or
+    `?format=binary` it is served from `video_heatmaps`, downsampled to N buckets, as JSON or as packed float32 values.
+    '''
+    if "buckets" not in request.args and "format" not in request.args:
+        bunny_api_response = make_api_request(
+            url = f"https://video.bunnycdn.com/library/{libraryId}/videos/{videoId}/heatmap",
+            method = str(request.method),
+            json = request.json,
+            headers = {
+                "AccessKey": _library_api_key
+            },
+            stream = True
+        )
+        return make_api_response(bunny_api_response, request.metadata)
+
+    buckets = request.args.get("buckets", HEATMAP_MAX_BUCKETS, type = int)
+    aggregate = request.args.get("aggregate", "mean")
+    encoding = request.args.get("format", "json")
+    if buckets is None or not 1 <= buckets <= HEATMAP_MAX_BUCKETS:
+        return make_response(jsonify(f"buckets must be an integer between 1 and {HEATMAP_MAX_BUCKETS}"), 400)
+    if aggregate not in HEATMAP_AGGREGATES:
+        return make_response(jsonify(f"aggregate must be one of {', '.join(HEATMAP_AGGREGATES)}"), 400)
+    if encoding not in ("json", "binary"):
+        return make_response(jsonify("format must be json or binary"), 400)
+
+    heatmap = video_heatmaps.get((libraryId, videoId))
+    if heatmap is None:
+        bunny_api_response = make_api_request(
+            url = f"https://video.bunnycdn.com/library/{libraryId}/videos/{videoId}/heatmap",
+            method = "GET",
+            headers = {
+                "AccessKey": _library_api_key
+            },
+            stream = False
+        )
+        if bunny_api_response.status_code != 200:
+            return make_api_response(bunny_api_response, request.metadata)
+        heatmap = parse_heatmap(bunny_api_response.json())
+        video_heatmaps.set((libraryId, videoId), heatmap)
+
+    values = downsample_heatmap(heatmap, buckets, aggregate)
+    bucket_seconds = len(heatmap) / len(values) if len(values) > 0 else 0
+
+    if encoding == "binary":
+        if sys.byteorder == "big":
+            values.byteswap() # The binary format is little-endian float32 regardless of the host.
+        api_response = make_response(values.tobytes())
+        api_response.content_type = "application/octet-stream"
+        api_response.headers["X-Heatmap-Duration"] = str(len(heatmap))
+        api_response.headers["X-Heatmap-Buckets"] = str(len(values))
+        api_response.headers["X-Heatmap-Bucket-Seconds"] = f"{bucket_seconds:g}"
+        return api_response
+
+    return jsonify({
+        "duration": len(heatmap),
+        "buckets": len(values),
+        "bucketSeconds": bucket_seconds,
+        "aggregate": aggregate,
+        "values": [round(value, 3) for value in values]
+    })
+
+def parse_heatmap(body: dict) -> array:
+    '''Turns Bunny's `{"heatmap": {"<second>": views}}` into a dense array of views per second.'''
+    points = {int(second): views for second, views in (body.get("heatmap") or {}).items()}
+    heatmap = array("d", bytes(8 * (max(points) + 1 if points else 0)))
+    for second, views in points.items():
+        if second >= 0:
+            heatmap[second] = views
+    return heatmap
+
+def downsample_heatmap(heatmap: array, buckets: int, aggregate: str) -> array:
+    '''Aggregates a per-second heatmap into at most `buckets` equally sized float32 buckets.'''
+    duration = len(heatmap)
+    if buckets >= duration:
+        return array("f", heatmap)
+    aggregate_window = HEATMAP_AGGREGATES[aggregate]
+    return array("f", (
+        aggregate_window(heatmap[bucket * duration // buckets:(bucket + 1) * duration // buckets])
+        for bucket in range(buckets)
+    ))
 
 @require_library_api_key
 def GetVideoPlayData(libraryId, videoId, _library_api_key):
@@ -399,7 +1264,8 @@ def GetVideoPlayData(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -416,10 +1282,137 @@ def GetVideoStatistics(libraryId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
+def GetStatisticsRollup():
+    '''
+    Fetches `GetVideoStatistics` for several libraries concurrently, from `?libraries=a,b,c` or a POST body of
+    `{"libraries": [...]}`, and merges them into one document.
+    A `dateFrom`..`dateTo` report is assembled from one document per library and day in `library_daily_statistics`, so
+    overlapping reports only ask Bunny for the days they don't share. A library missing more than `STATISTICS_TOP_UP_DAYS`
+    of them is asked for the whole range in one query instead. Other query parameters (hourly, videoGuid, ...) are
+    forwarded to every library and cached by exact query, in `library_statistics` like those range queries.
+    '''
+    library_ids, problem = request_id_list("libraries", "libraries", STATISTICS_MAX_LIBRARIES)
+    if problem is not None:
+        return problem
+
+    query = sorted((key, value) for key, value in request.args.items(multi = True) if key != "libraries")
+    daily = all(key in ("dateFrom", "dateTo") for key, _ in query)
+    if daily:
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        try:
+            last = datetime.date.fromisoformat(request.args["dateTo"][:10]) if "dateTo" in request.args else today
+            first = (
+                datetime.date.fromisoformat(request.args["dateFrom"][:10]) if "dateFrom" in request.args
+                else last - datetime.timedelta(days = STATISTICS_DEFAULT_DAYS - 1)
+            )
+        except ValueError:
+            return make_response(jsonify("dateFrom and dateTo must be ISO 8601 dates"), 400)
+        if first > last:
+            return make_response(jsonify("dateFrom must not be after dateTo"), 400)
+        # Longer ranges would cost a call per day, so they go to Bunny as one query like any other.
+        daily = (last - first).days < STATISTICS_MAX_DAYS
+    # (libraryId, day) -> query of every day a library has no live document for, with day `None` for exact queries,
+    # whose documents go to `cached`.
+    wanted = {}
+    cached = {}
+    if daily:
+        range_query = urlencode({"dateFrom": first.isoformat(), "dateTo": last.isoformat()})
+        for libraryId in library_ids:
+            days = library_daily_statistics.missing_days(libraryId, first, last)
+            if len(days) <= STATISTICS_TOP_UP_DAYS:
+                for day in days:
+                    wanted[(libraryId, day)] = urlencode({"dateFrom": day.isoformat(), "dateTo": day.isoformat()})
+                continue
+            # Fetching every day would cost a call each, so mostly cold libraries are served from one range query.
+            cached[libraryId] = library_statistics.get((libraryId, range_query))
+            if cached[libraryId] is None:
+                wanted[(libraryId, None)] = range_query
+    else:
+        query_string = urlencode(query)
+        cached = {libraryId: library_statistics.get((libraryId, query_string)) for libraryId in library_ids}
+        wanted = {(libraryId, None): query_string for libraryId, document in cached.items() if document is None}
+
+    errors = {}
+    missing = list(dict.fromkeys(libraryId for libraryId, _ in wanted))
+    api_keys = retrieve_library_api_keys(missing, max_workers = STATISTICS_CONCURRENCY)
+    for libraryId in missing:
+        if api_keys[libraryId] is None:
+            errors[libraryId] = {"status": 404, "message": request.metadata['responses'][404]}
+        elif isinstance(api_keys[libraryId], requests.RequestException):
+            errors[libraryId] = upstream_error(api_keys[libraryId])
+    wanted = {(libraryId, day): wanted_query for (libraryId, day), wanted_query in wanted.items() if libraryId not in errors}
+
+    bunny_api_responses = make_api_requests(
+        [
+            {
+                "url": f"https://video.bunnycdn.com/library/{libraryId}/statistics" + (f"?{wanted_query}" if wanted_query else ""),
+                "method": "GET",
+                "headers": {
+                    "AccessKey": api_keys[libraryId]
+                }
+            }
+            for (libraryId, _), wanted_query in wanted.items()
+        ],
+        max_workers = STATISTICS_CONCURRENCY
+    )
+    for ((libraryId, day), wanted_query), bunny_api_response in zip(wanted.items(), bunny_api_responses):
+        if libraryId in errors:
+            continue # One failed day fails the library, so its other days' errors aren't reported again.
+        if isinstance(bunny_api_response, requests.RequestException):
+            errors[libraryId] = upstream_error(bunny_api_response)
+            continue
+        if bunny_api_response.status_code == 200:
+            if day is not None:
+                library_daily_statistics.store(libraryId, day, bunny_api_response.json(), today)
+            else:
+                cached[libraryId] = bunny_api_response.json()
+                library_statistics.set((libraryId, wanted_query), cached[libraryId])
+            continue
+        if bunny_api_response.status_code == 401:
+            invalidate_library_api_key(libraryId) # The next rollup looks the key up again.
+        errors[libraryId] = {
+            "status": bunny_api_response.status_code,
+            "message": request.metadata['responses'].get(bunny_api_response.status_code, "Unknown response code.")
+        }
+
+    merged_ids = [libraryId for libraryId in library_ids if libraryId not in errors]
+    statistics = [
+        cached[libraryId] if libraryId in cached else merge_statistics(library_daily_statistics.assemble(libraryId, first, last))
+        for libraryId in merged_ids
+    ]
+    return jsonify({
+        "libraries": merged_ids,
+        "statistics": merge_statistics(statistics),
+        "errors": errors
+    })
+
+def merge_statistics(documents: list) -> dict:
+    '''
+    Merges statistics documents: time series and per-country maps are summed key by key, other numbers are summed
+    too, except `STATISTICS_AVERAGED_FIELDS`, which are averaged over the documents that have them.
+    '''
+    merged = {}
+    averaged = {}
+    for document in documents:
+        for field, value in document.items():
+            if isinstance(value, dict):
+                series = merged.setdefault(field, {})
+                for key, amount in value.items():
+                    series[key] = series.get(key, 0) + (amount or 0)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                if field in STATISTICS_AVERAGED_FIELDS:
+                    averaged.setdefault(field, []).append(value)
+                else:
+                    merged[field] = merged.get(field, 0) + value
+    for field, values in averaged.items():
+        merged[field] = sum(values) / len(values)
+    return merged
+
 @require_library_api_key
 def ReencodeVideo(libraryId, videoId, _library_api_key):
     bunny_api_response = make_api_request(
@@ -428,7 +1421,8 @@ def ReencodeVideo(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -445,12 +1439,21 @@ def RepackageVideo(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
 @require_library_api_key
 def ListVideos(libraryId, _library_api_key):
+    if request.args.get("all", "").lower() == "true":
+        return stream_all_pages(
+            f"https://video.bunnycdn.com/library/{libraryId}/videos",
+            headers = {
+                "AccessKey": _library_api_key
+            }
+        )
+
     if request.query_string.decode() != "":
         query_string = f"?{request.query_string.decode()}"
     else:
@@ -462,7 +1465,8 @@ def ListVideos(libraryId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -474,7 +1478,8 @@ def CreateVideo(libraryId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -491,7 +1496,8 @@ def SetThumbnail(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -508,7 +1514,8 @@ def FetchVideo(libraryId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -520,7 +1527,8 @@ def AddCaption(libraryId, videoId, sourceLang, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -532,7 +1540,8 @@ def DeleteCaption(libraryId, videoId, sourceLang, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -549,10 +1558,120 @@ def TranscribeVideo(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
+def caption_batch_call(libraryId: str, item: dict) -> tuple:
+    '''The (url, JSON body) of one batch item: an `AddCaption` upload when it has "caption", otherwise a `TranscribeVideo` request.'''
+    videoId = item["videoId"]
+    if "caption" in item:
+        caption = dict(item["caption"])
+        caption.setdefault("srclang", item["language"])
+        return f"https://video.bunnycdn.com/library/{libraryId}/videos/{videoId}/captions/{item['language']}", caption
+
+    options = dict(item["transcribe"])
+    query = {"language": item.get("language") or options.pop("language", None), "force": options.pop("force", None)}
+    query = {key: str(value).lower() if isinstance(value, bool) else value for key, value in query.items() if value is not None}
+    url = f"https://video.bunnycdn.com/library/{libraryId}/videos/{videoId}/transcribe"
+    return (url + "?" + urlencode(query) if query else url), options
+
+def validate_caption_batch(items) -> str:
+    '''Returns why a caption batch can't be run, or `None` when it is valid.'''
+    if not isinstance(items, list) or len(items) == 0:
+        return "The request body must contain a non-empty \"items\" array"
+    if len(items) > CAPTION_BATCH_MAX_ITEMS:
+        return f"At most {CAPTION_BATCH_MAX_ITEMS} items can be sent at once"
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get("videoId"), str) or not item["videoId"].strip():
+            return f"Item {index} has no videoId"
+        if ("caption" in item) == ("transcribe" in item):
+            return f"Item {index} must have either \"caption\" or \"transcribe\""
+        if not isinstance(item.get("caption", item.get("transcribe")), dict):
+            return f"Item {index} must give its caption or transcription options as an object"
+        if "caption" in item and not isinstance(item.get("language"), str):
+            return f"Item {index} has a caption but no language"
+    return None
+
+@require_library_api_key
+def CaptionBatch(libraryId, _library_api_key):
+    '''
+    Adds captions and queues transcriptions for many videos in one call, from a JSON body of `{"items": [...]}` where each item is
+    `{"videoId", "language", "caption": {...}}` (the `AddCaption` body) or `{"videoId", "language", "transcribe": {...}}`
+    (the `TranscribeVideo` body, plus an optional "force").
+    The library key is resolved once and the items run concurrently; each result is streamed as an NDJSON line as soon as it is
+    known, followed by a summary line. Items are retried on 5xx answers and transport errors, and wait out rate limits and open circuits.
+    '''
+    items = (request.get_json(silent = True) or {}).get("items")
+    problem = validate_caption_batch(items)
+    if problem is not None:
+        return make_response(jsonify(problem), 400)
+
+    policy = request_upstream_policy() # The body is generated outside the request context.
+    api_key = {"value": _library_api_key, "refreshed": False}
+    api_key_lock = threading.Lock()
+
+    def refresh_api_key(rejected: str) -> str:
+        '''Looks the key up again after a 401, once per batch; items rejected with the old key retry with the new one.'''
+        with api_key_lock:
+            if api_key["value"] == rejected and not api_key["refreshed"]:
+                invalidate_library_api_key(libraryId)
+                api_key["value"] = retrieve_library_api_key(libraryId)
+                api_key["refreshed"] = True
+            return api_key["value"]
+
+    def run_item(index: int, item: dict) -> dict:
+        url, body = caption_batch_call(libraryId, item)
+        sent_with = [None] # The key of the latest attempt, so a 401 refreshes only a key that is still current.
+
+        def send():
+            sent_with[0] = api_key["value"]
+            return make_api_request(
+                url = url,
+                method = "POST",
+                json = body,
+                headers = {
+                    "AccessKey": sent_with[0]
+                },
+                stream = False,
+                policy = policy
+            )
+
+        status, attempts, error = retry_upstream_call(
+            send,
+            attempts = CAPTION_BATCH_ATTEMPTS,
+            max_wait = CAPTION_BATCH_MAX_WAIT,
+            policy = policy,
+            retry_unauthorized = lambda: refresh_api_key(sent_with[0]) != sent_with[0]
+        )
+        result = {
+            "index": index,
+            "videoId": item["videoId"],
+            "language": item.get("language") or item.get("transcribe", {}).get("language"),
+            "action": "caption" if "caption" in item else "transcribe",
+            "status": status,
+            "attempts": attempts
+        }
+        if error is not None:
+            result["error"] = error
+        return result
+
+    def generate():
+        executor = ThreadPoolExecutor(max_workers = max(1, min(CAPTION_BATCH_CONCURRENCY, len(items))))
+        succeeded = 0
+        try:
+            futures = [executor.submit(run_item, index, item) for index, item in enumerate(items)]
+            for future in as_completed(futures):
+                result = future.result()
+                succeeded += result.get("status") is not None and result["status"] < 400
+                yield json.dumps(result) + "\n"
+            yield json.dumps({"summary": {"total": len(items), "succeeded": succeeded, "failed": len(items) - succeeded}}) + "\n"
+        finally:
+            executor.shutdown(wait = False, cancel_futures = True) # A client that hangs up stops the items not yet started.
+
+    return Response(generate(), mimetype = "application/x-ndjson")
+
 @require_library_api_key
 def VideoResolutionInfo(libraryId, videoId, _library_api_key):
     bunny_api_response = make_api_request(
@@ -561,7 +1680,8 @@ def VideoResolutionInfo(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
@@ -573,20 +1693,52 @@ def CleanupUnconfiguredResolutions(libraryId, videoId, _library_api_key):
         json = request.json,
         headers = {
             "AccessKey": _library_api_key
-        }
+        },
+        stream = True
     )
     return make_api_response(bunny_api_response, request.metadata)
 
 @require_library_api_key
 def CreateUploadSignature(libraryId, videoId, _library_api_key):
-    expiration = (datetime.datetime.now() + datetime.timedelta(hours=2))
-    expiration = int(expiration.timestamp())
+    expiration = upload_signature_expiration()
+    return jsonify({
+        "signature": upload_signature(libraryId, _library_api_key, videoId, expiration),
+        "expiration": expiration
+    })
 
-    signature = hashlib.sha256(
-        (str(libraryId) + str(_library_api_key) + str(expiration) + str(videoId)).encode()
-    )
+@require_library_api_key
+def CreateUploadSignatures(libraryId, _library_api_key):
+    '''
+    Signs TUS uploads for several videos of one library at once, from `?ids=a,b,c` or a POST body of `{"ids": [...]}`.
+    The library key is resolved once and every signature shares one expiration.
+    '''
+    video_ids, problem = request_id_list("ids", "video IDs", UPLOAD_SIGNATURE_MAX_IDS)
+    if problem is not None:
+        return problem
 
+    expiration = upload_signature_expiration()
     return jsonify({
-        "signature": signature.hexdigest(),
+        "signatures": {
+            videoId: upload_signature(libraryId, _library_api_key, videoId, expiration) for videoId in video_ids
+        },
         "expiration": expiration
-    })
\ No newline at end of file
+    })
+
+def upload_signature_expiration() -> int:
+    '''Unix timestamp at which upload signatures created now expire, `UPLOAD_SIGNATURE_TTL` seconds from now.'''
+    expiration = (datetime.datetime.now() + datetime.timedelta(seconds=UPLOAD_SIGNATURE_TTL))
+    return int(expiration.timestamp())
+
+def upload_signature(libraryId, api_key: str, videoId, expiration: int) -> str:
+    '''
+    TUS upload signature: sha256(libraryId + apiKey + expiration + videoId).
+    The hash state after the `libraryId + apiKey` prefix is cached, so each signature only hashes its own suffix.
+    '''
+    prefix = upload_signature_prefixes.get((libraryId, api_key))
+    if prefix is None:
+        prefix = hashlib.sha256((str(libraryId) + str(api_key)).encode())
+        upload_signature_prefixes.set((libraryId, api_key), prefix)
+
+    signature = prefix.copy()
+    signature.update((str(expiration) + str(videoId)).encode())
+    return signature.hexdigest()
@@ -0,0 +1,131 @@
+"""
+Pooled, keep-alive HTTP sessions for talking to Bunny's upstream hosts.
+
+Each upstream host (`api.bunny.net`, `video.bunnycdn.com`, ...) gets its own `requests.Session`
+with a tuned `HTTPAdapter`, so TCP/TLS connections are reused across proxied calls instead of
+being re-established every time.
+"""
+import os
+import socket
+import threading
+from os import environ
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+POOL_MAXSIZE = int(environ.get('BUNNY_POOL_MAXSIZE', 32))         # Connections kept alive per host.
+POOL_BLOCK = environ.get('BUNNY_POOL_BLOCK', 'true').lower() == 'true' # Wait for a free connection instead of opening a throwaway one.
+POOL_TIMEOUT = float(environ.get('BUNNY_POOL_TIMEOUT', 10))        # Seconds to wait for a free connection when blocking.
+KEEPALIVE = environ.get('BUNNY_POOL_KEEPALIVE', 'true').lower() == 'true'
+KEEPALIVE_IDLE = int(environ.get('BUNNY_POOL_KEEPALIVE_IDLE', 60)) # Seconds idle before TCP keep-alive probes start.
+
+
+class _PoolStatsMixin:
+    '''Counts how often a caller found every connection of the pool checked out.'''
+    num_waits = 0
+
+    def _get_conn(self, timeout = None):
+        if self.pool is not None and self.pool.empty():
+            self.num_waits += 1
+        if timeout is None:
+            timeout = POOL_TIMEOUT
+        return super()._get_conn(timeout)
+
+
+class _TrackedHTTPConnectionPool(_PoolStatsMixin, HTTPConnectionPool):
+    pass
+
+
+class _TrackedHTTPSConnectionPool(_PoolStatsMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledAdapter(HTTPAdapter):
+    '''`HTTPAdapter` whose urllib3 pools track connection reuse and waits.'''
+
+    def init_poolmanager(self, connections, maxsize, block = POOL_BLOCK, **pool_kwargs):
+        if KEEPALIVE:
+            socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE))
+            pool_kwargs["socket_options"] = socket_options
+
+        super().init_poolmanager(connections, maxsize, block = block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TrackedHTTPConnectionPool,
+            "https": _TrackedHTTPSConnectionPool
+        }
+
+    def pool_stats(self) -> dict:
+        '''Sums the counters of every urllib3 pool this adapter currently holds.'''
+        stats = {"connections": 0, "requests": 0, "waits": 0}
+        pools = self.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["connections"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+            stats["waits"] += getattr(pool, "num_waits", 0)
+        return stats
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_sessions_pid = os.getpid()
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = PooledAdapter(pool_connections = 1, pool_maxsize = POOL_MAXSIZE, pool_block = POOL_BLOCK)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not KEEPALIVE:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def reset_sessions() -> None:
+    '''Drops every pooled session. Called in forked children so sockets are never shared between processes.'''
+    global _sessions, _sessions_lock, _sessions_pid
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+    _sessions_pid = os.getpid()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child = reset_sessions)
+
+
+def get_session(url: str) -> requests.Session:
+    '''Returns the pooled session for the host of `url`, creating it on first use.'''
+    if os.getpid() != _sessions_pid:
+        reset_sessions()
+
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = _build_session()
+                _sessions[host] = session
+    return session
+
+
+def pool_stats() -> dict:
+    '''Returns connection pool statistics for every upstream host used by this process.'''
+    stats = {}
+    for host, session in list(_sessions.items()):
+        host_stats = session.get_adapter("https://" + host).pool_stats()
+        requests_made = host_stats["requests"]
+        host_stats["reuse_ratio"] = round(1 - host_stats["connections"] / requests_made, 4) if requests_made else 0.0
+        host_stats["maxsize"] = POOL_MAXSIZE
+        stats[host] = host_stats
+    return {
+        "pid": os.getpid(),
+        "hosts": stats
+    }
@@ -0,0 +1,168 @@
+"""
+Rate limiting primitives for calls made to Bunny.
+"""
+import contextlib
+import email.utils
+import hashlib
+import threading
+import time
+
+import requests
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket: `rate` tokens are added per second, up to `capacity`.
+    Each call takes one token, waiting for it to be refilled when the bucket is empty.
+    '''
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        '''Takes a token, returning how many seconds the caller must wait before using it.'''
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        '''Blocks until a token is available, returning the seconds spent waiting.'''
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def refund(self) -> None:
+        '''Returns a token taken by `reserve` that ended up not being used.'''
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+
+class UpstreamThrottled(requests.RequestException):
+    '''Raised instead of calling Bunny when a request would have to queue longer than the scheduler allows.'''
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"Upstream rate limit reached, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value, default: float) -> float:
+    '''Parses a Retry-After header given either as seconds or as an HTTP date.'''
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class RequestScheduler:
+    '''
+    Admits upstream requests through one token bucket per AccessKey and one per upstream host.
+    A 429 from Bunny pauses the AccessKey for its Retry-After. Requests queue for their turn up to `max_wait` seconds
+    and `max_queue` waiters; beyond that they are shed with `UpstreamThrottled` instead of hammering upstream.
+    '''
+    def __init__(self, key_rate: float, host_rate: float, max_wait: float, max_queue: int, retry_after_default: float = 1.0) -> None:
+        self.key_rate = key_rate
+        self.host_rate = host_rate
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.retry_after_default = retry_after_default
+        self.queued = 0
+        self.delayed = 0
+        self.shed = 0
+        self.upstream_429s = 0
+        self._buckets = {}
+        self._paused_until = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_label(access_key: str) -> str:
+        '''Stable, non-secret name for an AccessKey in statistics.'''
+        return "key:" + hashlib.sha256(str(access_key).encode()).hexdigest()[:12]
+
+    def _bucket(self, name: str, rate: float) -> TokenBucket:
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(name, TokenBucket(rate = rate))
+        return bucket
+
+    def reserve(self, access_key: str, host: str) -> float:
+        '''
+        Reserves a slot for one request, returning how many seconds it must wait before being sent.
+        Raises `UpstreamThrottled` when the wait or the queue would exceed the configured limits.
+        '''
+        key_name = self.key_label(access_key)
+        host_name = "host:" + host
+        buckets = [self._bucket(key_name, self.key_rate), self._bucket(host_name, self.host_rate)]
+        delay = max(bucket.reserve() for bucket in buckets)
+        delay = max(delay, self._paused_until.get(key_name, 0) - time.monotonic())
+
+        if delay > 0 and (delay > self.max_wait or self.queued >= self.max_queue):
+            for bucket in buckets:
+                bucket.refund()
+            self.shed += 1
+            raise UpstreamThrottled(delay)
+        if delay > 0:
+            self.delayed += 1
+        return max(0.0, delay)
+
+    def admit(self, access_key: str, host: str) -> None:
+        '''Blocks the calling thread until the request may be sent (see `reserve`).'''
+        delay = self.reserve(access_key, host)
+        if delay <= 0:
+            return
+        with self.waiting():
+            time.sleep(delay)
+
+    @contextlib.contextmanager
+    def waiting(self):
+        '''Counts the caller in the queue depth while it waits for its reserved slot.'''
+        with self._lock:
+            self.queued += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.queued -= 1
+
+    def record_response(self, access_key: str, status_code: int, retry_after = None) -> None:
+        '''Pauses the AccessKey when Bunny answered 429, for as long as its Retry-After asks.'''
+        if status_code != 429:
+            return
+        self.upstream_429s += 1
+        pause = parse_retry_after(retry_after, self.retry_after_default)
+        key_name = self.key_label(access_key)
+        with self._lock:
+            self._paused_until[key_name] = max(self._paused_until.get(key_name, 0), time.monotonic() + pause)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "queued": self.queued,
+            "delayed": self.delayed,
+            "shed": self.shed,
+            "upstream_429s": self.upstream_429s,
+            "paused": {
+                name: round(until - now, 1) for name, until in list(self._paused_until.items()) if until > now
+            },
+            "key_rate": self.key_rate,
+            "host_rate": self.host_rate,
+            "max_wait": self.max_wait,
+            "max_queue": self.max_queue
+        }